@@ -0,0 +1,160 @@
+"""
+Analytics over the append-only availability history.
+
+Availability only gets a new row when something has changed, so each row
+describes the state of a product from its timestamp up to the timestamp of
+the next row. All aggregation is done by sqlite with window functions over
+ix_availability_product_id_timestamp; python only ever sees one row per
+restock, per (product, size) or per product.
+"""
+
+import time
+
+from typing import Iterable, Optional
+from sqlalchemy.orm import Session
+from sqlalchemy import select, func, case, and_, true
+
+from models import Availability, Info
+
+
+def in_stock_expr():
+    """1 if an availability row describes a product that can be bought, else 0."""
+    return case(
+        (
+            and_(
+                Availability.included_in_last_update == True,
+                Availability.available == True,
+                Availability.status == "ACTIVE",
+            ),
+            1,
+        ),
+        else_=0,
+    )
+
+
+def availability_history(product_ids: Optional[Iterable[int]] = None):
+    """
+    returns:
+    a subquery of availability rows, each with the in_stock and
+    included_in_last_update values of the previous row and the timestamp
+    of the next row of the same product.
+    """
+    in_stock = in_stock_expr()
+    window = {
+        "partition_by": Availability.product_id,
+        "order_by": (Availability.timestamp, Availability.id),
+    }
+
+    q = select(
+        Availability.product_id,
+        Availability.timestamp,
+        Availability.avail_skus,
+        Availability.included_in_last_update.label("included"),
+        in_stock.label("in_stock"),
+        func.lag(in_stock).over(**window).label("prev_in_stock"),
+        func.lag(Availability.included_in_last_update).over(**window).label("prev_included"),
+        func.lead(Availability.timestamp).over(**window).label("next_timestamp"),
+    )
+    if product_ids is not None:
+        q = q.where(Availability.product_id.in_(list(product_ids)))
+
+    return q.subquery()
+
+
+def query_restocks(
+    session: Session, product_ids: Optional[Iterable[int]] = None
+) -> dict[int, list[int]]:
+    """
+    A restock is an availability row that is in stock, while the previous
+    row of the same product was not. A product's first row is not a restock.
+
+    returns:
+    a mapping of product_id to the timestamps of its restocks, in order.
+    """
+    h = availability_history(product_ids)
+    rows = session.execute(
+        select(h.c.product_id, h.c.timestamp)
+        .where(h.c.in_stock == 1, h.c.prev_in_stock == 0)
+        .order_by(h.c.product_id, h.c.timestamp)
+    )
+
+    restocks: dict[int, list[int]] = {}
+    for product_id, ts in rows:
+        restocks.setdefault(product_id, []).append(ts)
+    return restocks
+
+
+def query_time_in_stock_by_size(
+    session: Session,
+    product_ids: Optional[Iterable[int]] = None,
+    now: Optional[int] = None,
+) -> dict[int, dict[str, int]]:
+    """
+    A size is in stock while its product is in stock and its level is not
+    "OOS". The most recent row of a product lasts until now.
+
+    returns:
+    a mapping of product_id to {size: seconds in stock}.
+    """
+    now = now or int(time.time())
+
+    h = availability_history(product_ids)
+    skus = func.json_each(h.c.avail_skus).table_valued("key", "value")
+    duration = func.coalesce(h.c.next_timestamp, now) - h.c.timestamp
+
+    rows = session.execute(
+        select(h.c.product_id, skus.c.key, func.sum(duration))
+        .select_from(h)
+        .join(skus, true())
+        .where(h.c.in_stock == 1, skus.c.value != "OOS")
+        .group_by(h.c.product_id, skus.c.key)
+    )
+
+    in_stock: dict[int, dict[str, int]] = {}
+    for product_id, size, seconds in rows:
+        in_stock.setdefault(product_id, {})[size] = seconds
+    return in_stock
+
+
+def query_flap_counts(
+    session: Session,
+    product_ids: Optional[Iterable[int]] = None,
+    limit: Optional[int] = None,
+) -> dict[int, int]:
+    """
+    A flap is a product dropping out of the feed, i.e. an availability row
+    that is not included_in_last_update, while the previous row was.
+
+    returns:
+    a mapping of product_id to its number of flaps, most flaps first.
+    """
+    h = availability_history(product_ids)
+    flaps = func.count().label("flaps")
+    q = (
+        select(h.c.product_id, flaps)
+        .where(h.c.included == False, h.c.prev_included == True)
+        .group_by(h.c.product_id)
+        .order_by(flaps.desc())
+    )
+    if limit is not None:
+        q = q.limit(limit)
+
+    return {product_id: count for product_id, count in session.execute(q)}
+
+
+def query_product_ids_by_style_color(session: Session, style_color: str) -> list[int]:
+    rows = session.query(Info.product_id).filter(Info.style_color == style_color).distinct()
+    return [r[0] for r in rows]
+
+
+def format_duration(seconds: float) -> str:
+    """e.g. 93784 -> '1d 2h 3m'"""
+    minutes = int(seconds) // 60
+    days, minutes = divmod(minutes, 60 * 24)
+    hours, minutes = divmod(minutes, 60)
+
+    if days:
+        return f"{days}d {hours}h {minutes}m"
+    if hours:
+        return f"{hours}h {minutes}m"
+    return f"{minutes}m"
@@ -0,0 +1,62 @@
+"""
+Measures how long importing each module takes in a fresh interpreter,
+using python's -X importtime. Importing a module must not connect to the
+database, read credentials or build the telegram application.
+
+usage: python bench_imports.py [repeat] [module ...]
+"""
+
+import os
+import sys
+import statistics
+import subprocess
+
+MODULES = [
+    "parse",
+    "crawl",
+    "database",
+    "models",
+    "queries",
+    "mirror",
+    "transactions",
+    "writer",
+    "watchlist",
+    "analytics",
+    "export",
+    "images",
+    "pipeline",
+    "shard",
+    "tgram",
+    "main",
+    "cli",
+]
+
+
+def import_time_us(module: str) -> int:
+    """returns: the cumulative import time of module in microseconds."""
+    res = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+
+    # lines look like "import time:       123 |       4567 | module"
+    for line in reversed(res.stderr.splitlines()):
+        fields = line.split("|")
+        if len(fields) == 3 and fields[2].strip() == module:
+            return int(fields[1])
+
+    raise ValueError(f"no import time reported for {module}")
+
+
+def main(repeat: int, modules: list[str]):
+    for module in modules:
+        times = [import_time_us(module) for _ in range(repeat)]
+        sys.stdout.write(f"{module:>14}: {statistics.median(times) / 1000:8.1f} ms\n")
+
+
+if __name__ == "__main__":
+    repeat = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    main(repeat, sys.argv[2:] or MODULES)
@@ -0,0 +1,135 @@
+import time
+import asyncio
+
+from typing import Any, Callable, Iterable, Optional
+
+Query = Callable[..., Any]
+
+
+def run_query(query: Query, *args) -> Any:
+    """run query in a session of its own. Returned objects are detached."""
+    from database import get_session
+
+    with get_session() as session:
+        return query(session, *args)
+
+
+class QueryCache:
+    """
+    QueryCache is a read-through cache for the functions in queries.py.
+    Results are keyed by query and arguments, and stay valid until a change
+    that they depend on is written (see invalidate).
+
+    Concurrent requests for the same key are coalesced: only the first
+    one runs the query (in a worker thread), all others await its result.
+
+    Query results must be fully loaded before they are returned, because
+    they are used after the session that produced them has been closed.
+
+    max_age_sec bounds the lifetime of a result regardless of changes.
+    It is needed because availability also depends on the current time
+    (see queries.is_available), which no change set reflects. Expired
+    results are purged at most every max_age_sec, when a new result is
+    stored: results that depend on a few product_ids (e.g. /pid_ lookups)
+    are rarely invalidated, and would otherwise be kept forever.
+    """
+
+    def __init__(self, max_age_sec: float = 60):
+        self.max_age_sec = max_age_sec
+
+        # key -> (result, expires_at, product_ids the result depends on)
+        self.results: dict[tuple, tuple[Any, float, Optional[frozenset[int]]]] = {}
+        self.inflight: dict[tuple, asyncio.Task] = {}
+        self.generation = 0
+        self.next_purge = time.monotonic() + max_age_sec
+
+    async def get(
+        self, query: Query, *args, depends_on: Optional[Iterable[int]] = None
+    ) -> Any:
+        """
+        returns:
+        the cached result of query(session, *args), computing it if needed.
+
+        depends_on restricts invalidation to changes of the given product_ids
+        (Product.id). By default, any change invalidates the result.
+        """
+        key = (query.__name__, *args)
+
+        cached = self.results.get(key)
+        if cached is not None and cached[1] > time.monotonic():
+            return cached[0]
+
+        task = self.inflight.get(key)
+        if task is None:
+            deps = frozenset(depends_on) if depends_on is not None else None
+            task = asyncio.ensure_future(self._compute(key, deps, query, *args))
+            self.inflight[key] = task
+
+        # shield, so that a cancelled caller does not cancel the other waiters.
+        return await asyncio.shield(task)
+
+    async def _compute(
+        self, key: tuple, deps: Optional[frozenset[int]], query: Query, *args
+    ) -> Any:
+        generation = self.generation
+        try:
+            result = await asyncio.to_thread(run_query, query, *args)
+        finally:
+            if self.inflight.get(key) is asyncio.current_task():
+                self.inflight.pop(key)
+
+        # do not store results that may predate an invalidation.
+        if generation == self.generation:
+            now = time.monotonic()
+            if now >= self.next_purge:
+                self.purge(now)
+            self.results[key] = (result, now + self.max_age_sec, deps)
+
+        return result
+
+    def invalidate(self, all_changes: dict[str, list[int]]) -> int:
+        """
+        invalidate drops all results that depend on a product_id in
+        all_changes, e.g. the product_ids of a written batch.
+
+        returns:
+        the number of dropped results.
+        """
+        changed = set(id for ids in all_changes.values() for id in ids)
+        if not changed:
+            return 0
+
+        self.generation += 1
+        self.inflight.clear()
+
+        stale = [
+            key
+            for key, (_, _, deps) in self.results.items()
+            if deps is None or not deps.isdisjoint(changed)
+        ]
+        for key in stale:
+            self.results.pop(key)
+
+        return len(stale)
+
+    def purge(self, now: float) -> int:
+        """
+        drops the results that expired before now.
+
+        returns:
+        the number of dropped results.
+        """
+        expired = [key for key, (_, expires_at, _) in self.results.items() if expires_at <= now]
+        for key in expired:
+            self.results.pop(key)
+        self.next_purge = now + self.max_age_sec
+
+        return len(expired)
+
+    def clear(self):
+        self.generation += 1
+        self.inflight.clear()
+        self.results.clear()
+
+
+query_cache = QueryCache()
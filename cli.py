@@ -0,0 +1,352 @@
+"""
+Command line interface.
+
+usage: python cli.py [--db PATH] COMMAND ...
+
+  run       crawl and run the telegram bot (same as main.py)
+  crawl     crawl without the telegram bot, optionally a single cycle
+  worker    crawl a share of the feeds, one of several worker processes
+  record    crawl and save the raw feeds to a file, for replay
+  replay    replay recorded feeds into a scratch database, with timings
+  rebuild   create missing indexes, reindex, analyze, reload latest states
+  compact   delete history rows that repeat the previous row, vacuum
+  bench     time the bot's queries against the database
+  export    export the snapshot history to parquet/arrow files
+
+Modules are imported by the commands that need them, so that e.g. replay
+never imports the telegram bot.
+"""
+
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import statistics
+
+from typing import Union
+
+
+def get_marketplaces(args) -> list[str]:
+    """returns: the marketplaces selected with --marketplace, or the default ones."""
+    from crawl import MARKETPLACES, MARKETPLACE_LANGUAGES
+
+    unknown = [m for m in args.marketplace or [] if m not in MARKETPLACE_LANGUAGES]
+    if unknown:
+        sys.exit(f"unknown marketplaces: {unknown}, choose from {list(MARKETPLACE_LANGUAGES)}")
+
+    return args.marketplace or MARKETPLACES
+
+
+def cmd_run(args):
+    import main
+
+    main.main(check=args.check_mirror, marketplaces=get_marketplaces(args), crawl=not args.no_crawl)
+
+
+def cmd_crawl(args):
+    import main
+    from profiling import profiler
+
+    profiler.request(args.profile)
+    asyncio.run(main.run_crawler(args.once, args.check_mirror, get_marketplaces(args)))
+
+
+def cmd_worker(args):
+    from shard import run_worker
+
+    if not 0 <= args.index < args.count:
+        sys.exit(f"index must be in [0, {args.count})")
+    asyncio.run(run_worker(args.index, args.count, get_marketplaces(args), args.check_mirror))
+
+
+def cmd_record(args):
+    from crawl import crawl_marketplaces
+
+    marketplaces = get_marketplaces(args)
+
+    async def record():
+        with open(args.out, "a") as f:
+            for i in range(args.cycles):
+                if i:
+                    await asyncio.sleep(args.interval)
+
+                results = await crawl_marketplaces(marketplaces)
+                feeds = {m: r for m, r in results.items() if not isinstance(r, Exception)}
+                # replayed as failed crawls, see cmd_replay.
+                errors = {m: repr(r) for m, r in results.items() if isinstance(r, Exception)}
+                f.write(json.dumps({"timestamp": int(time.time()), "feeds": feeds, "errors": errors}) + "\n")
+                f.flush()
+
+                counts = {m: len(r) if m in feeds else repr(r) for m, r in results.items()}
+                sys.stdout.write(f"cycle {i}: {counts}\n")
+
+    asyncio.run(record())
+
+
+def cmd_replay(args):
+    import database
+
+    if os.path.exists(args.scratch):
+        os.remove(args.scratch)
+    database.set_database_url(f"sqlite:///{os.path.abspath(args.scratch)}")
+
+    import main
+    from crawl import ANCHORS
+    from writer import write_queue
+    from pipeline import Pipeline
+
+    with open(args.feed, "r") as f:
+        records = [json.loads(line) for line in f if line.strip()] * args.repeat
+    cycles = [record["feeds"] for record in records]
+    errors = [record.get("errors", {}) for record in records]
+    marketplaces = sorted(set().union(*cycles, *errors))
+
+    # a recorded feed is served in pages of about the size of nike's pages,
+    # each delayed by --latency, at most 4 pages in flight per marketplace.
+    page_size = ANCHORS.step
+
+    async def pages(cycle: int, marketplace: str):
+        # a marketplace that failed to crawl must not look like an empty feed,
+        # which would discontinue all of its products.
+        if marketplace in errors[cycle]:
+            raise RuntimeError(f"recorded crawl error: {errors[cycle][marketplace]}")
+        if marketplace not in cycles[cycle]:
+            raise RuntimeError(f"{marketplace} was not recorded in cycle {cycle}")
+        infos = cycles[cycle][marketplace]
+        semaphore = asyncio.Semaphore(4)
+
+        async def get_page(i: int) -> list:
+            async with semaphore:
+                await asyncio.sleep(args.latency / 1000)
+            return infos[i:i + page_size]
+
+        for task in asyncio.as_completed([get_page(i) for i in range(0, len(infos), page_size)]):
+            yield await task
+
+    async def sequential():
+        for i in range(len(cycles)):
+            t0 = time.perf_counter()
+
+            async def fetch(marketplace: str) -> Union[list, Exception]:
+                try:
+                    return [info async for page in pages(i, marketplace) for info in page]
+                except Exception as e:
+                    return e
+
+            results = dict(zip(marketplaces, await asyncio.gather(*[fetch(m) for m in marketplaces])))
+            t1 = time.perf_counter()
+            all_changes, rows, _ = main.process(results)
+            t2 = time.perf_counter()
+            await write_queue.put(rows)
+
+            changes = sum(len(v) for v in all_changes.values())
+            sys.stdout.write(
+                f"cycle {i}: {changes} changes, {len(rows)} rows"
+                f" | fetch {(t1 - t0) * 1000:.1f} ms | diff {(t2 - t1) * 1000:.1f} ms\n"
+            )
+
+    async def replay():
+        main.setup()
+        write_queue.start()
+
+        t0 = time.perf_counter()
+        if args.sequential:
+            await sequential()
+        else:
+            pipeline = Pipeline(main.ConsoleNotifier(), marketplaces, pages=pages, throttle_sec=0)
+            await pipeline.run(len(cycles))
+        t_cycles = time.perf_counter() - t0
+        await write_queue.close()
+        t_total = time.perf_counter() - t0
+
+        n_products = sum(len(infos) for feeds in cycles for infos in feeds.values())
+        sys.stdout.write(
+            f"{'sequential' if args.sequential else 'pipeline'}: {len(cycles)} cycles in"
+            f" {t_cycles:.3f} s, {n_products / t_cycles:.0f} products/s"
+            f" | all rows written after {t_total:.3f} s\n"
+        )
+
+    asyncio.run(replay())
+
+
+def cmd_rebuild(args):
+    from sqlalchemy import text
+    from database import get_engine, get_session
+    from models import init_db
+    from mirror import StateMirror
+
+    t0 = time.perf_counter()
+    init_db()
+    with get_engine().begin() as conn:
+        conn.execute(text("REINDEX"))
+        conn.execute(text("ANALYZE"))
+    sys.stdout.write(f"indexes rebuilt in {time.perf_counter() - t0:.3f} s\n")
+
+    t0 = time.perf_counter()
+    mirror = StateMirror()
+    with get_session() as session:
+        mirror.load(session)
+    sys.stdout.write(
+        f"latest state of {len(mirror.products)} products loaded in {time.perf_counter() - t0:.3f} s\n"
+    )
+
+
+def cmd_compact(args):
+    from sqlalchemy import select, delete, text
+    from database import get_engine, get_session
+    from parse import InfoState, LaunchState, AvailabilityState
+    from models import Info, Launch, Availability
+
+    for model, state in [(Info, InfoState), (Launch, LaunchState), (Availability, AvailabilityState)]:
+        table = model.__table__
+        columns = [table.c[k] for k in state._fields]
+
+        with get_session() as session:
+            rows = session.execute(
+                select(table.c.id, table.c.product_id, *columns)
+                .order_by(table.c.product_id, table.c.id)
+                .execution_options(yield_per=10_000)
+            )
+
+            # a row is redundant if it has the same state as the previous
+            # row of the same product.
+            duplicates, prev = [], None
+            for id, product_id, *values in rows:
+                if prev is not None and prev == (product_id, values):
+                    duplicates.append(id)
+                prev = (product_id, values)
+
+            for i in range(0, len(duplicates), 1000):
+                session.execute(delete(table).where(table.c.id.in_(duplicates[i:i + 1000])))
+            session.commit()
+
+        sys.stdout.write(f"{table.name}: deleted {len(duplicates)} rows\n")
+
+    if args.vacuum:
+        t0 = time.perf_counter()
+        with get_engine().connect() as conn:
+            conn.execution_options(isolation_level="AUTOCOMMIT").execute(text("VACUUM"))
+        sys.stdout.write(f"vacuumed in {time.perf_counter() - t0:.3f} s\n")
+
+
+def cmd_bench(args):
+    import queries
+    import analytics
+    from database import get_session
+    from mirror import StateMirror
+
+    benchmarks = {
+        "mirror.load": lambda session: StateMirror().load(session),
+        "available": queries.query_all_available_products,
+        "hidden": queries.query_hidden_products,
+        "restricted": queries.query_restricted_products,
+        "restocks": analytics.query_restocks,
+        "time_in_stock": analytics.query_time_in_stock_by_size,
+        "flaps": analytics.query_flap_counts,
+    }
+
+    for name, query in benchmarks.items():
+        times = []
+        for _ in range(args.repeat):
+            # a fresh session per run, so that nothing is served from its identity map.
+            with get_session() as session:
+                t0 = time.perf_counter()
+                result = query(session)
+                times.append(time.perf_counter() - t0)
+
+        size = len(result) if result is not None else "-"
+        sys.stdout.write(
+            f"{name:>14}: median {statistics.median(times) * 1000:8.1f} ms,"
+            f" min {min(times) * 1000:8.1f} ms, {size} results\n"
+        )
+
+
+def cmd_export(args):
+    from database import get_session
+    from export import export, EXPORT_DIR
+
+    with get_session() as session:
+        counts = export(session, args.out or EXPORT_DIR, args.format, args.chunk_size)
+    sys.stdout.write(f"exported rows: {counts}\n")
+
+
+def parse_args(argv: list[str]):
+    parser = argparse.ArgumentParser(prog="cli.py", description="snkrs monitor")
+    parser.add_argument("--db", help="path of the sqlite database (default: snkrs.db)")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    def add_marketplace_arg(p):
+        p.add_argument(
+            "--marketplace", nargs="+", type=str.upper,
+            help="marketplaces to crawl (default: crawl.MARKETPLACES)",
+        )
+
+    p = commands.add_parser("run", help="crawl and run the telegram bot")
+    p.add_argument("--check-mirror", action="store_true", help="verify the state mirror after each cycle")
+    p.add_argument("--no-crawl", action="store_true", help="run the bot only, next to workers")
+    add_marketplace_arg(p)
+    p.set_defaults(func=cmd_run)
+
+    p = commands.add_parser("crawl", help="crawl without the telegram bot")
+    p.add_argument("--once", action="store_true", help="run a single cycle")
+    p.add_argument("--profile", type=int, default=0, metavar="N", help="profile the first N cycles")
+    p.add_argument("--check-mirror", action="store_true", help="verify the state mirror after each cycle")
+    add_marketplace_arg(p)
+    p.set_defaults(func=cmd_crawl)
+
+    p = commands.add_parser("worker", help="crawl a share of the feeds, see shard.py")
+    p.add_argument("index", type=int, help="index of this worker, from 0")
+    p.add_argument("count", type=int, help="number of workers")
+    p.add_argument("--check-mirror", action="store_true", help="verify the state mirror after each cycle")
+    add_marketplace_arg(p)
+    p.set_defaults(func=cmd_worker)
+
+    p = commands.add_parser("record", help="save raw feeds for replay")
+    p.add_argument("out", help="file to append the feeds to (json lines)")
+    p.add_argument("--cycles", type=int, default=1)
+    p.add_argument("--interval", type=float, default=10, help="seconds between cycles")
+    add_marketplace_arg(p)
+    p.set_defaults(func=cmd_record)
+
+    p = commands.add_parser("replay", help="replay recorded feeds into a scratch database")
+    p.add_argument("feed", help="file written by record")
+    p.add_argument("--scratch", default="replay.db", help="scratch database, overwritten")
+    p.add_argument("--repeat", type=int, default=1, help="replay the feeds this many times")
+    p.add_argument("--latency", type=float, default=0, help="simulated latency of each page in ms")
+    p.add_argument("--sequential", action="store_true", help="fetch, then diff, one cycle at a time")
+    p.set_defaults(func=cmd_replay)
+
+    p = commands.add_parser("rebuild", help="rebuild indexes and reload latest states")
+    p.set_defaults(func=cmd_rebuild)
+
+    p = commands.add_parser("compact", help="delete redundant history rows (stop the crawler first)")
+    p.add_argument("--vacuum", action="store_true", help="vacuum the database afterwards")
+    p.set_defaults(func=cmd_compact)
+
+    p = commands.add_parser("bench", help="time queries")
+    p.add_argument("--repeat", type=int, default=5)
+    p.set_defaults(func=cmd_bench)
+
+    p = commands.add_parser("export", help="export history to columnar files")
+    p.add_argument("out", nargs="?", help="output directory (default: export/)")
+    p.add_argument("--format", choices=["parquet", "arrow"], default="parquet")
+    p.add_argument("--chunk-size", type=int, default=100_000)
+    p.set_defaults(func=cmd_export)
+
+    return parser.parse_args(argv)
+
+
+def main(argv: list[str]):
+    args = parse_args(argv)
+
+    if args.db is not None and args.command != "replay":
+        import database
+        database.set_database_url(f"sqlite:///{os.path.abspath(args.db)}")
+
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
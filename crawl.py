@@ -1,17 +1,33 @@
 import asyncio
-import aiohttp
 
-from typing import Any
+from typing import TYPE_CHECKING, Any, AsyncIterator, Union
+
+if TYPE_CHECKING:
+    import aiohttp
 
 NIKE_HEADERS = {
     "Accept-Encoding": "gzip, deflate",
     "User-Agent": "SNKRS-inhouse/4.26.0 (com.nike.onenikecommerce",
 }
 
-URL_TEMPLATE = "https://snkrs.services.nike.com/snkrs/content/v1/?anchor={}&language=fr&marketplace=FR&includeContentThreads=true&format=v5&exclusiveAccess=true%2Cfalse"
+URL_TEMPLATE = "https://snkrs.services.nike.com/snkrs/content/v1/?anchor={anchor}&language={language}&marketplace={marketplace}&includeContentThreads=true&format=v5&exclusiveAccess=true%2Cfalse"
+
+# language used for each marketplace's feed.
+MARKETPLACE_LANGUAGES = {
+    "FR": "fr",
+    "US": "en",
+    "GB": "en-GB",
+    "DE": "de",
+    "JP": "ja",
+}
+
+# marketplaces that are crawled by main.step.
+MARKETPLACES = ["FR"]
+
+ANCHORS = range(0, 400, 40)
 
 
-async def get_request(session: aiohttp.ClientSession, url: str) -> dict:
+async def get_request(session: "aiohttp.ClientSession", url: str) -> dict:
     async with session.get(url, headers=NIKE_HEADERS) as res:
         res.raise_for_status()
         return await res.json()
@@ -35,33 +51,114 @@ def filter_out_duplicates(data: list):
     return new_data
 
 
-async def crawl_product_and_content_infos() -> list[tuple[dict[str, Any], dict[str, Any]]]:
+async def crawl_product_and_content_infos(
+    session: "aiohttp.ClientSession",
+    marketplace: str,
+    semaphore: asyncio.Semaphore,
+) -> list[tuple[dict[str, Any], dict[str, Any]]]:
     """ 
-    Crawl_product_and_content_infos fetches nike's product feed, and does 
-    some amount of preliminary data manipulation to get from nike's nested json 
-    format to relatively simpler python dictionaries.
+    Crawl_product_and_content_infos fetches nike's product feed of a
+    marketplace, and does some amount of preliminary data manipulation to
+    get from nike's nested json format to relatively simpler python
+    dictionaries. At most semaphore's value requests are in flight at once.
 
     returns:
     a list of (content_info, product_info ) tuples.
     """
-    urls = [URL_TEMPLATE.format(i) for i in range(0, 400, 40)]
-    # urls = [URL_TEMPLATE.format(i) for i in range(0, 200, 40)]
+    language = MARKETPLACE_LANGUAGES[marketplace]
+    urls = [
+        URL_TEMPLATE.format(anchor=i, language=language, marketplace=marketplace)
+        for i in ANCHORS
+    ]
 
-    async with aiohttp.ClientSession() as session:
-        # request nike sneakers app content (feed).
-        data_ = await asyncio.gather(*[get_request(session, url) for url in urls])
+    async def get_page(url: str) -> dict:
+        async with semaphore:
+            return await get_request(session, url)
+
+    # request nike sneakers app content (feed).
+    data_ = await asyncio.gather(*[get_page(url) for url in urls])
+
+    # transform data_ into list in which each entry is a product card.
+    data: list[dict] = flatten(list(data_), "objects")
+
+    # get rid of duplicates, keep only cards that have "product info.
+    data = filter_out_duplicates(data)
+    data = [d for d in data if d.get("productInfo") is not None]
+
+    ### return extract lists of productInfos and publishedContents from data.
+    content_infos = [d["publishedContent"] for d in data for _ in range(len(d["productInfo"]))]
+    product_infos =  [item for d in data for item in d["productInfo"]]
+
+    infos = [(content_infos[i], product_infos[i]) for i in range(len(product_infos))]
 
-        # transform data_ into list in which each entry is a product card.
-        data: list[dict] = flatten(list(data_), "objects")
+    return infos
 
-        # get rid of duplicates, keep only cards that have "product info.
-        data = filter_out_duplicates(data)
-        data = [d for d in data if d.get("productInfo") is not None]
 
-        ### return extract lists of productInfos and publishedContents from data.
-        content_infos = [d["publishedContent"] for d in data for _ in range(len(d["productInfo"]))]
-        product_infos =  [item for d in data for item in d["productInfo"]]
+async def get_page(session: "aiohttp.ClientSession", marketplace: str, anchor: int) -> dict:
+    """returns: the feed page of marketplace that starts at anchor."""
+    language = MARKETPLACE_LANGUAGES[marketplace]
+    url = URL_TEMPLATE.format(anchor=anchor, language=language, marketplace=marketplace)
+    return await get_request(session, url)
 
-        infos = [(content_infos[i], product_infos[i]) for i in range(len(product_infos))]
 
-        return infos
+def page_infos(page: dict) -> list[tuple[dict[str, Any], dict[str, Any]]]:
+    """returns: the (content_info, product_info) tuples of a single feed page."""
+    return [
+        (d["publishedContent"], product_info)
+        for d in page["objects"]
+        if d.get("productInfo") is not None
+        for product_info in d["productInfo"]
+    ]
+
+
+async def iter_pages(
+    session: "aiohttp.ClientSession",
+    marketplace: str,
+    semaphore: asyncio.Semaphore,
+) -> AsyncIterator[list[tuple[dict[str, Any], dict[str, Any]]]]:
+    """
+    iter_pages is the streaming version of crawl_product_and_content_infos:
+    it yields the (content_info, product_info) tuples of each page as soon
+    as it arrives, in no particular order. Cards that appear on several
+    pages are yielded several times. Raises if any page fails.
+    """
+    async def get_page_(anchor: int) -> dict:
+        async with semaphore:
+            return await get_page(session, marketplace, anchor)
+
+    tasks = [asyncio.ensure_future(get_page_(i)) for i in ANCHORS]
+    try:
+        for task in asyncio.as_completed(tasks):
+            yield page_infos(await task)
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+async def crawl_marketplaces(
+    marketplaces: list[str], max_concurrency: int = 4
+) -> dict[str, Union[list[tuple[dict[str, Any], dict[str, Any]]], Exception]]:
+    """
+    crawl_marketplaces crawls the feeds of all marketplaces concurrently,
+    over one shared connection pool. Each marketplace has at most
+    max_concurrency requests in flight, so that a large number of
+    marketplaces does not get us throttled.
+
+    returns:
+    a mapping of marketplace to its (content_info, product_info) tuples,
+    or to the exception that crawling it raised.
+    """
+    import aiohttp
+
+    async with aiohttp.ClientSession() as session:
+        results = await asyncio.gather(
+            *[
+                crawl_product_and_content_infos(
+                    session, marketplace, asyncio.Semaphore(max_concurrency)
+                )
+                for marketplace in marketplaces
+            ],
+            return_exceptions=True,
+        )
+
+    return dict(zip(marketplaces, results))
@@ -1,20 +1,45 @@
 import os
+from typing import Optional
 from sqlalchemy import create_engine
+from sqlalchemy.engine import Engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 
 PATH = os.path.dirname(__file__)
 
 DATABASE_URL = f"sqlite:///{PATH}/snkrs.db"
-print("DATABASE_URL: ", DATABASE_URL)
 
 # DATABASE_URL = "sqlite://"
 
-engine = create_engine(DATABASE_URL, echo=False, future=True)
-
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 Base = declarative_base()
 
+# created on first use, see get_engine.
+_engine: Optional[Engine] = None
+_session_local: Optional[sessionmaker] = None
+
+
+def set_database_url(url: str):
+    """use another database. Must be called before the engine is created."""
+    global DATABASE_URL
+    assert _engine is None, "engine has already been created"
+    DATABASE_URL = url
+
+
+def get_engine() -> Engine:
+    """
+    returns:
+    the engine, which is created (but not connected) on the first call.
+    """
+    global _engine, _session_local
+    if _engine is None:
+        print("DATABASE_URL: ", DATABASE_URL)
+        _engine = create_engine(DATABASE_URL, echo=False, future=True)
+        _session_local = sessionmaker(autocommit=False, autoflush=False, bind=_engine)
+
+    return _engine
+
 
 def get_session():
-    return SessionLocal()
+    get_engine()
+    assert _session_local is not None
+    return _session_local()
@@ -0,0 +1,167 @@
+import os
+import sys
+import json
+
+from datetime import datetime, timezone
+from typing import Any, Iterator
+from sqlalchemy import select, Boolean, Integer
+from sqlalchemy.orm import Session
+
+from database import Base, PATH
+from models import Product, Info, Launch, Availability
+
+EXPORT_DIR = os.path.join(PATH, "export")
+EXPORT_MODELS: list[type[Base]] = [Product, Info, Launch, Availability]
+FORMATS = {"parquet": ".parquet", "arrow": ".arrow"}
+
+
+def arrow_schema(model: type[Base]):
+    """the arrow schema of a model's table."""
+    import pyarrow as pa
+
+    def arrow_type(column):
+        if isinstance(column.type, Boolean):
+            return pa.bool_()
+        if isinstance(column.type, Integer):
+            return pa.int64()
+        return pa.string()
+
+    fields = [pa.field(c.name, arrow_type(c)) for c in model.__table__.columns]
+    return pa.schema(fields)
+
+
+def iter_chunks(
+    session: Session, model: type[Base], after_id: int, chunk_size: int
+) -> Iterator[list[Any]]:
+    """
+    iter_chunks reads all rows of model's table with id > after_id, in
+    chunks of at most chunk_size rows. Chunks are read by id ranges
+    (keyset pagination), so memory stays bounded and each query is an
+    index range scan, no matter how large the table is.
+    """
+    table = model.__table__
+    while True:
+        rows = session.execute(
+            select(table).where(table.c.id > after_id).order_by(table.c.id).limit(chunk_size)
+        ).all()
+        if not rows:
+            return
+
+        yield rows
+        after_id = rows[-1].id
+
+
+def partition(row) -> str:
+    """
+    rows are partitioned by the UTC date of their timestamp. Products have
+    no timestamp, they are not partitioned.
+    """
+    if "timestamp" not in row._fields:
+        return ""
+
+    ts = row.timestamp
+    date = datetime.fromtimestamp(ts, timezone.utc).strftime("%Y-%m-%d") if ts else "unknown"
+    return f"date={date}"
+
+
+def write_chunk(rows: list[Any], model: type[Base], out_dir: str, fmt: str) -> list[str]:
+    """
+    writes one file per date partition of rows, e.g.
+    <out_dir>/info/date=2022-06-12/part-000000001201-000000001400.parquet
+
+    returns:
+    the paths of the written files.
+    """
+    import pyarrow as pa
+
+    schema = arrow_schema(model)
+
+    partitions: dict[str, list[Any]] = {}
+    for row in rows:
+        partitions.setdefault(partition(row), []).append(row)
+
+    paths = []
+    for name, part in partitions.items():
+        table = pa.Table.from_pylist([row._asdict() for row in part], schema=schema)
+
+        part_dir = os.path.join(out_dir, model.__tablename__, name)
+        os.makedirs(part_dir, exist_ok=True)
+        path = os.path.join(part_dir, f"part-{part[0].id:012d}-{part[-1].id:012d}{FORMATS[fmt]}")
+
+        # write to a temporary file first, so that readers never see partial files.
+        tmp_path = path + ".tmp"
+        if fmt == "parquet":
+            import pyarrow.parquet as pq
+            pq.write_table(table, tmp_path)
+        else:
+            # uncompressed arrow ipc files can be memory mapped by readers.
+            with pa.OSFile(tmp_path, "wb") as sink:
+                with pa.ipc.new_file(sink, schema) as writer:
+                    writer.write_table(table)
+        os.replace(tmp_path, path)
+        paths.append(path)
+
+    return paths
+
+
+def read_state(out_dir: str) -> dict[str, int]:
+    """returns: the last exported id of each table."""
+    path = os.path.join(out_dir, "_state.json")
+    if not os.path.exists(path):
+        return {}
+
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def write_state(out_dir: str, state: dict[str, int]):
+    path = os.path.join(out_dir, "_state.json")
+    with open(path + ".tmp", "w") as f:
+        json.dump(state, f, indent=4)
+    os.replace(path + ".tmp", path)
+
+
+def export(
+    session: Session,
+    out_dir: str = EXPORT_DIR,
+    fmt: str = "parquet",
+    chunk_size: int = 100_000,
+) -> dict[str, int]:
+    """
+    export appends all rows that have been added since the previous export
+    to columnar files in out_dir, partitioned by table and date. The last
+    exported id of each table is saved after every chunk, so an interrupted
+    export resumes where it stopped.
+
+    The result can be read as a hive partitioned dataset, e.g.
+    pyarrow.dataset.dataset(f"{out_dir}/availability", partitioning="hive")
+
+    returns:
+    the number of exported rows per table.
+    """
+    if fmt not in FORMATS:
+        raise ValueError(f"format must be one of {list(FORMATS)}")
+
+    os.makedirs(out_dir, exist_ok=True)
+    state = read_state(out_dir)
+
+    counts = {}
+    for model in EXPORT_MODELS:
+        name = model.__tablename__
+        counts[name] = 0
+
+        for rows in iter_chunks(session, model, state.get(name, 0), chunk_size):
+            write_chunk(rows, model, out_dir, fmt)
+            counts[name] += len(rows)
+            state[name] = rows[-1].id
+            write_state(out_dir, state)
+
+    return counts
+
+
+if __name__ == "__main__":
+    from database import get_session
+
+    out_dir = sys.argv[1] if len(sys.argv) > 1 else EXPORT_DIR
+    with get_session() as session:
+        print("exported rows: ", export(session, out_dir))
@@ -0,0 +1,191 @@
+"""
+Image cache for product notifications. Each product image is downloaded
+once, over a single pooled client, and kept on disk; the least recently
+used images are deleted once the cache exceeds max_bytes.
+
+An image is uploaded to telegram only once: the file_id telegram returns
+for the first photo sent with it is kept (in file_ids.json, next to the
+images) and used for every later send, to any chat. Telegram keeps the
+file, so evicting the image from disk does not cause another upload.
+"""
+
+import os
+import sys
+import json
+import asyncio
+import hashlib
+
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from typing import TYPE_CHECKING, Optional
+
+if TYPE_CHECKING:
+    import aiohttp
+
+IMAGE_DIR = os.path.join(os.path.dirname(__file__), "images")
+
+
+class ImageCache:
+    def __init__(self, path: str = IMAGE_DIR, max_bytes: int = 200_000_000, max_connections: int = 4):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_connections = max_connections
+        self.session: Optional["aiohttp.ClientSession"] = None
+
+        # file name -> size, least recently used first.
+        self.files: OrderedDict[str, int] = OrderedDict()
+        self.size = 0
+        # url -> telegram file_id
+        self.file_ids: dict[str, str] = {}
+        # url -> lock, so that an image is downloaded and uploaded once, and
+        # the number of tasks holding or waiting for it (see locked).
+        self.locks: dict[str, asyncio.Lock] = {}
+        self.lock_users: dict[str, int] = {}
+        self.loaded = False
+
+    def load(self):
+        """reads the cached images and file_ids, oldest first."""
+        os.makedirs(self.path, exist_ok=True)
+        entries = [e for e in os.scandir(self.path) if e.name.endswith(".img")]
+        for entry in sorted(entries, key=lambda e: e.stat().st_mtime):
+            self.files[entry.name] = entry.stat().st_size
+        self.size = sum(self.files.values())
+
+        file_ids_path = os.path.join(self.path, "file_ids.json")
+        if os.path.exists(file_ids_path):
+            with open(file_ids_path, "r") as f:
+                self.file_ids = json.load(f)
+        self.loaded = True
+
+    def get_session(self) -> "aiohttp.ClientSession":
+        import aiohttp
+
+        if self.session is None:
+            self.session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.max_connections)
+            )
+        return self.session
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    @asynccontextmanager
+    async def locked(self, url: str):
+        """
+        holds the lock of url. Locks are dropped once no task holds or waits
+        for them, so that there are only as many as images being worked on.
+        """
+        lock = self.locks.setdefault(url, asyncio.Lock())
+        self.lock_users[url] = self.lock_users.get(url, 0) + 1
+        try:
+            async with lock:
+                yield
+        finally:
+            self.lock_users[url] -= 1
+            if self.lock_users[url] == 0:
+                del self.lock_users[url]
+                del self.locks[url]
+
+    @staticmethod
+    def file_name(url: str) -> str:
+        return hashlib.sha1(url.encode()).hexdigest() + ".img"
+
+    async def get(self, url: str) -> bytes:
+        """returns: the image at url, downloaded if it is not cached."""
+        if not self.loaded:
+            self.load()
+
+        async with self.locked(url):
+            name = self.file_name(url)
+            path = os.path.join(self.path, name)
+            if name in self.files:
+                try:
+                    # the mtime keeps the lru order across restarts.
+                    os.utime(path)
+                    with open(path, "rb") as f:
+                        data = f.read()
+                    self.files.move_to_end(name)
+                    return data
+                except FileNotFoundError:
+                    # deleted behind our back, download it again.
+                    self.size -= self.files.pop(name)
+
+            async with self.get_session().get(url) as res:
+                res.raise_for_status()
+                data = await res.read()
+
+            try:
+                with open(path + ".tmp", "wb") as f:
+                    f.write(data)
+                os.replace(path + ".tmp", path)
+            except OSError as e:
+                # e.g. the disk is full, the image can still be sent.
+                sys.stdout.write(f"failed to cache {url}:\n{e}\n")
+                return data
+
+            self.files[name] = len(data)
+            self.size += len(data)
+            self.evict()
+            return data
+
+    def evict(self):
+        """deletes the least recently used images until size <= max_bytes."""
+        while self.size > self.max_bytes and len(self.files) > 1:
+            name, size = self.files.popitem(last=False)
+            self.size -= size
+            try:
+                os.remove(os.path.join(self.path, name))
+            except FileNotFoundError:
+                pass
+
+    async def prefetch(self, urls: list[str]):
+        """downloads the images at urls concurrently, ignoring failures."""
+        await asyncio.gather(*[self.get(url) for url in set(urls)], return_exceptions=True)
+
+    def set_file_id(self, url: str, file_id: str):
+        self.file_ids[url] = file_id
+
+        path = os.path.join(self.path, "file_ids.json")
+        with open(path + ".tmp", "w") as f:
+            json.dump(self.file_ids, f)
+        os.replace(path + ".tmp", path)
+
+    async def send_photo(self, bot, chat_id: int, url: str, **kwargs):
+        """
+        sends the image at url to chat_id with bot.send_photo; kwargs are
+        passed on (caption, parse_mode, ...). Uploads the image the first
+        time, and sends its file_id afterwards. Concurrent first sends of
+        the same image wait for the upload instead of uploading it again.
+        """
+        file_id = self.file_ids.get(url)
+        if file_id is not None:
+            return await bot.send_photo(chat_id=chat_id, photo=file_id, **kwargs)
+
+        data = await self.get(url)
+        async with self.locked(url):
+            file_id = self.file_ids.get(url)
+            if file_id is not None:
+                return await bot.send_photo(chat_id=chat_id, photo=file_id, **kwargs)
+
+            message = await bot.send_photo(chat_id=chat_id, photo=data, **kwargs)
+            # the largest size is last. The photo has been sent, so failing
+            # to save its file_id must not fail the send.
+            try:
+                self.set_file_id(url, message.photo[-1].file_id)
+            except OSError as e:
+                sys.stdout.write(f"failed to save the file_id of {url}:\n{e}\n")
+            return message
+
+
+image_cache = ImageCache()
+
+
+if __name__ == "__main__":
+    # prints the state of the cache, e.g. python images.py
+    image_cache.load()
+    sys.stdout.write(
+        f"{len(image_cache.files)} images, {image_cache.size / 1e6:.1f} MB"
+        f" (max {image_cache.max_bytes / 1e6:.0f} MB), {len(image_cache.file_ids)} file_ids\n"
+    )
@@ -1,80 +1,221 @@
 import sys
 import asyncio
 
-from collections import defaultdict
-
-import tgram
-from datetime import datetime
-from transactions import update_db, handle_discontinued_products
-from parse import parse_info
-from crawl import crawl_product_and_content_infos
-from database import get_session
-
-
-async def step():
-    # crawl and parse
-    infos = await crawl_product_and_content_infos()
-    product_dicts = [parse_info(*info) for info in infos]
+import watchlist
+from typing import TYPE_CHECKING, Any, Callable, Union
+from crawl import MARKETPLACES
+from cache import query_cache
+from profiling import install_signal_handler
+
+# the database layer is imported by the functions that use it.
+if TYPE_CHECKING:
+    from writer import Row
+
+
+class ConsoleNotifier:
+    """
+    stands in for tgram when the crawler runs without the telegram bot.
+    Changes are already printed by the pipeline, admin messages go to stdout.
+    Change events are still written, and delivered once the bot runs.
+    """
+
+    def publish_events(self, events: list[dict[str, Any]]):
+        pass
+
+    async def dispatch_to_admin(self, text: str):
+        sys.stdout.write(f"\n{text}\n")
+
+
+def process(
+    results: dict[str, Union[list[tuple[dict[str, Any], dict[str, Any]]], Exception]],
+) -> tuple[dict[str, list[int]], list["Row"], dict[str, Exception]]:
+    """
+    process parses complete crawled feeds and diffs them against
+    state_mirror, which is updated in place. This is what a pipeline cycle
+    does, without the pipelining (see cli.py replay --sequential).
+
+    returns:
+    all changes, the rows that persist them, and the marketplaces that
+    failed to crawl.
+    """
+    from transactions import update_products, handle_discontinued_products, new_changes
+    from parse import parse_info
+    from mirror import state_mirror
 
     # keeps track of all changes made to db.
-    all_changes = defaultdict(list) 
-    all_changes = {"discontinued": [], "availability": [], "launch": [], "info": [], "add": []}
-    with get_session() as session:
-        # find discontinued products and update availability in db.
-        discontinued = handle_discontinued_products(session, [int(p["pid"]) for p in product_dicts])
-        if discontinued:
-            all_changes["discontinued"] += discontinued
-
-        # update db 
-        pids = []
-        for product_dict in product_dicts:
-            # ignore duplicates
-            pid = product_dict["pid"]
-            if pid in pids:
-                continue
-            pids.append(pid)
-
-            changes = update_db(session, product_dict)
-            for k, v in changes.items():
-                all_changes[k].append(v)
-
-        # alarm and notifications.
-        await tgram.dispatch_alarm(all_changes)
-
-
-        # dispatch messages
-        if any(all_changes.values()):
-            sys.stdout.write("\n" + " || ".join([f"{k}: {v}" for k , v in all_changes.items()]) + "\n")
-
-async def answer_ping():
-    for sub in tgram.subscriptions.values():
-        assert  isinstance(sub.queue, asyncio.Queue)
-        while not sub.queue.empty():
-            v = await sub.queue.get()
-            print("received value from queue: ", v, " -> ",  sub.queue.empty())
-            sub.queue.task_done()
-
-async def loop(throttle_sec: int=10, throttle_sec_on_error: int=60):
-    _throttle_sec = 0
+    all_changes = new_changes()
+    rows = []
+    errors = {}
+    for marketplace, infos in results.items():
+        if isinstance(infos, Exception):
+            errors[marketplace] = infos
+            continue
+
+        # parse
+        products = [parse_info(*info, marketplace) for info in infos]
+
+        # find discontinued products and update their availability.
+        discontinued, rows_ = handle_discontinued_products(
+            [p.pid for p in products], marketplace, state_mirror
+        )
+        all_changes["discontinued"] += discontinued
+        rows += rows_
+
+        # update state
+        changes, rows_ = update_products(products, state_mirror, set())
+        for k, v in changes.items():
+            all_changes[k] += v
+        rows += rows_
+
+    return all_changes, rows, errors
+
+async def step(notifier, marketplaces: list[str] = MARKETPLACES, check: bool = False):
+    """
+    runs a single crawl cycle.
+    notifier is either the tgram module or a ConsoleNotifier.
+    """
+    from pipeline import Pipeline
+
+    await Pipeline(notifier, marketplaces, check=check).run(cycles=1)
+
+async def loop(
+    notifier,
+    throttle_sec: int=10,
+    throttle_sec_on_error: int=60,
+    check: bool=False,
+    marketplaces: list[str] = MARKETPLACES,
+):
+    """
+    check: verify the state mirror against the database after each step.
+    The pipeline is restarted if it stops on an error.
+    """
+    from pipeline import Pipeline
 
     while True:
-        await asyncio.sleep(_throttle_sec)
-        await answer_ping()
-
+        pipeline = Pipeline(
+            notifier,
+            marketplaces,
+            check=check,
+            throttle_sec=throttle_sec,
+            throttle_sec_on_error=throttle_sec_on_error,
+        )
         try:
-            await step()
-            sys.stdout.write(f'{datetime.now().strftime("%H:%M:%S")}: slept for {_throttle_sec} seconds.\n')
+            await pipeline.run()
         except Exception as e:
-            sys.stdout.write(f"\nreceived error:\n{e}\n")
-            _throttle_sec = throttle_sec_on_error
-            await tgram.dispatch_to_admin(f"received exception:\n{e}")
-        sys.stdout.flush()
+            text = f"crawler stopped, restarting in {throttle_sec_on_error}s:\n{e!r}"
+            sys.stdout.write(f"\n{text}\n")
+            try:
+                await notifier.dispatch_to_admin(text)
+            except Exception as e:
+                sys.stdout.write(f"\nfailed to notify the admin:\n{e}\n")
+            await asyncio.sleep(throttle_sec_on_error)
+
+def invalidate_cache(product_ids: set[int]):
+    """cached query results are stale once changes have been written."""
+    query_cache.invalidate({"written": list(product_ids)})
+
+async def poll_database(on_commit: Callable[[set[int]], None], poll_sec: float = 2):
+    """
+    stands in for the write queue and the pipeline when the crawler runs
+    in other processes (see shard.py): passes the product_ids of change
+    events written since the last poll to on_commit, and notifies
+    pipeline.cycle_done whenever a new crawl cycle has started, i.e. the
+    previous one has completed.
+    """
+    from database import get_session
+    from queries import query_event_product_ids, query_last_event_id, query_last_crawl_cycle_id
+    from pipeline import cycle_done
+
+    def poll(after_id: int) -> tuple[list[tuple[int, int]], int]:
+        with get_session() as session:
+            return query_event_product_ids(session, after_id), query_last_crawl_cycle_id(session)
 
-        _throttle_sec = throttle_sec
+    with get_session() as session:
+        event_id = query_last_event_id(session)
+        cycle_id = query_last_crawl_cycle_id(session)
 
-def main():
-    asyncio.ensure_future(loop())
-    tgram.application.run_polling()
+    while True:
+        await asyncio.sleep(poll_sec)
+        try:
+            events, cycle_id_ = await asyncio.to_thread(poll, event_id)
+        except Exception as e:
+            sys.stdout.write(f"\nfailed to poll the database:\n{e}\n")
+            continue
+
+        if events:
+            event_id = events[-1][0]
+            on_commit(set(product_id for _, product_id in events))
+
+        if cycle_id_ != cycle_id:
+            cycle_id = cycle_id_
+            async with cycle_done:
+                cycle_done.notify_all()
+
+def setup():
+    """create/migrate the schema and load the state mirror."""
+    from database import get_session
+    from models import init_db
+    from mirror import state_mirror
+    from writer import write_queue
+
+    init_db()
+    with get_session() as session:
+        state_mirror.load(session)
+    write_queue.on_commit = invalidate_cache
+
+async def run_crawler(
+    once: bool = False, check: bool = False, marketplaces: list[str] = MARKETPLACES
+):
+    """run the crawler without the telegram bot."""
+    from writer import write_queue
+
+    setup()
+    notifier = ConsoleNotifier()
+    install_signal_handler(asyncio.get_running_loop())
+    write_queue.start()
+    try:
+        if once:
+            await step(notifier, marketplaces, check=check)
+        else:
+            await loop(notifier, check=check, marketplaces=marketplaces)
+    finally:
+        await write_queue.close()
+
+def main(check: bool = False, marketplaces: list[str] = MARKETPLACES, crawl: bool = True):
+    """
+    crawl=False runs the telegram bot only, e.g. next to the workers of
+    shard.py, which write the change events that the bot then polls for
+    (see poll_database).
+    """
+    import tgram
+    from models import init_db
+    from writer import write_queue
+
+    if crawl:
+        setup()
+    else:
+        init_db()
+    tgram.load_subscriptions()
+
+    def on_commit(product_ids: set[int]):
+        invalidate_cache(product_ids)
+        tgram.new_events.set()
+
+    write_queue.on_commit = on_commit
+    # writes the chats' cursors too, see tgram.deliver_events.
+    write_queue.start()
+    asyncio.ensure_future(watchlist.watch_file(tgram.watchlist_index, "watchlist.json"))
+    asyncio.ensure_future(tgram.delivery_loop())
+    if crawl:
+        asyncio.ensure_future(loop(tgram, check=check, marketplaces=marketplaces))
+        install_signal_handler(asyncio.get_event_loop())
+    else:
+        asyncio.ensure_future(poll_database(on_commit))
+    tgram.get_application().run_polling(close_loop=False)
+
+    # write everything that is still pending before exiting.
+    asyncio.get_event_loop().run_until_complete(write_queue.close())
+    asyncio.get_event_loop().run_until_complete(tgram.image_cache.close())
 
 if __name__ == "__main__":
-    main()
+    main(check="--check-mirror" in sys.argv)
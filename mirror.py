@@ -0,0 +1,257 @@
+import sys
+import json
+import time
+
+from dataclasses import dataclass
+from typing import Optional
+from sqlalchemy import select, func
+from sqlalchemy.orm import Session
+
+from parse import InfoState, LaunchState, AvailabilityState
+from models import Product, Info, Launch, Availability, ChangeEvent, Subscriber
+
+
+@dataclass(slots=True)
+class ProductState:
+    """
+    The latest state of a product, i.e. the values of its latest Info,
+    Launch and Availability rows. prev_availability is the availability
+    before the latest change (None for products with a single
+    availability row), which is what notifications are computed from.
+    """
+    product_id: int
+    pid: int
+    marketplace: str
+    info: InfoState
+    launch: LaunchState
+    availability: AvailabilityState
+    prev_availability: Optional[AvailabilityState]
+    timestamp: int
+
+    @property
+    def id(self) -> int:
+        """same name as Product.id."""
+        return self.product_id
+
+    def to_json(self) -> str:
+        """the state as stored in ChangeEvent.state, see from_json."""
+        prev = self.prev_availability
+        return json.dumps({
+            "pid": self.pid,
+            "marketplace": self.marketplace,
+            "info": self.info._asdict(),
+            "launch": self.launch._asdict(),
+            "availability": self.availability._asdict(),
+            "prev_availability": prev._asdict() if prev is not None else None,
+            "timestamp": self.timestamp,
+        })
+
+    @classmethod
+    def from_json(cls, product_id: int, s: str) -> "ProductState":
+        d = json.loads(s)
+        prev = d["prev_availability"]
+        return cls(
+            product_id=product_id,
+            pid=d["pid"],
+            marketplace=d["marketplace"],
+            info=InfoState(**d["info"]),
+            launch=LaunchState(**d["launch"]),
+            availability=AvailabilityState(**d["availability"]),
+            prev_availability=AvailabilityState(**prev) if prev is not None else None,
+            timestamp=d["timestamp"],
+        )
+
+
+def query_latest_rows(session: Session, model, state, n: int = 1):
+    """
+    returns:
+    rows of (product_id, timestamp, rn, *state fields) for the n latest rows
+    of each product in model's table. rn=1 is the latest row.
+    """
+    table = model.__table__
+    rn = func.row_number().over(partition_by=table.c.product_id, order_by=table.c.id.desc())
+    sub = select(
+        table.c.product_id, table.c.timestamp, rn.label("rn"),
+        *[table.c[k] for k in state._fields],
+    ).subquery()
+
+    return session.execute(select(sub).where(sub.c.rn <= n))
+
+
+class StateMirror:
+    """
+    StateMirror keeps the latest state of every product in memory, so that
+    a crawl cycle can be diffed without reading the database. It is loaded
+    once at startup (load), and from then on updated by the write path in
+    transactions.py as soon as a change is detected. The database is only
+    written to, in the background (see writer.py), so it may lag behind.
+
+    check compares the mirror with the database, which must always agree.
+    """
+
+    def __init__(self):
+        self.products: dict[tuple[str, int], ProductState] = {}
+        self.by_id: dict[int, ProductState] = {}
+        # product_ids of Products that lack Info, Launch or Availability
+        # rows, by (marketplace, pid), see load.
+        self.incomplete: dict[tuple[str, int], int] = {}
+        self.max_product_id = 0
+        self.max_event_id = 0
+        self.loaded = False
+
+    def get(self, marketplace: str, pid: int) -> Optional[ProductState]:
+        return self.products.get((marketplace, pid))
+
+    def add(self, state: ProductState):
+        self.products[(state.marketplace, state.pid)] = state
+        self.by_id[state.product_id] = state
+        self.max_product_id = max(self.max_product_id, state.product_id)
+
+    def remove(self, state: ProductState):
+        self.products.pop((state.marketplace, state.pid), None)
+        self.by_id.pop(state.product_id, None)
+
+    def next_product_id(self, marketplace: str, pid: int) -> int:
+        """
+        Product ids are assigned here rather than by the database, so that
+        new products can be referred to before they have been written. This
+        requires the mirror to be the only writer of products. An incomplete
+        product keeps its id, its missing rows are written with the new
+        product's.
+        """
+        product_id = self.incomplete.get((marketplace, pid))
+        return product_id if product_id is not None else self.max_product_id + 1
+
+    def next_event_id(self) -> int:
+        """
+        ChangeEvent ids are assigned here too, so that events can be
+        delivered before they have been written (see tgram.deliver_events).
+        """
+        self.max_event_id += 1
+        return self.max_event_id
+
+    def included_pids(self, marketplace: str) -> set[int]:
+        """returns: the pids of marketplace that were in the last update."""
+        return set(
+            state.pid
+            for state in self.products.values()
+            if state.marketplace == marketplace
+            and state.availability.included_in_last_update
+        )
+
+    def load(self, session: Session):
+        """
+        (re)load the latest state of all products from the database.
+
+        A product's rows are written in one transaction (see writer.py),
+        but older databases may have Products without Info, Launch or
+        Availability rows, or such rows without their Product. Those are
+        skipped and reported: the former are kept in incomplete, and the
+        latter's product_ids are never assigned again, nor are any that
+        the mirror assigned before the reload. Event ids are never assigned
+        again either, not even those of events that were delivered but
+        never written: they are above the ids in the database, and maybe
+        below a chat's cursor.
+        """
+        products: dict[int, tuple[int, str]] = {
+            id: (pid, marketplace)
+            for id, pid, marketplace in session.execute(
+                select(Product.id, Product.pid, Product.marketplace)
+            )
+        }
+
+        latest: dict[type, dict[int, tuple]] = {}
+        timestamps: dict[int, int] = {}
+        prev_availability: dict[int, AvailabilityState] = {}
+        for model, state in [
+            (Info, InfoState),
+            (Launch, LaunchState),
+            (Availability, AvailabilityState),
+        ]:
+            n = 2 if model is Availability else 1
+            latest[model] = {}
+            for row in query_latest_rows(session, model, state, n):
+                product_id, ts, rn, *values = row
+                if rn == 2:
+                    prev_availability[product_id] = state(*values)
+                    continue
+
+                latest[model][product_id] = state(*values)
+                timestamps[product_id] = max(timestamps.get(product_id, 0), ts or 0)
+
+        max_product_id = max(
+            self.max_product_id,
+            max(products, default=0),
+            *[max(rows, default=0) for rows in latest.values()],
+        )
+        orphans = set().union(*latest.values()) - products.keys()
+
+        self.products, self.by_id, self.incomplete = {}, {}, {}
+        for product_id, (pid, marketplace) in products.items():
+            if any(product_id not in rows for rows in latest.values()):
+                self.incomplete[(marketplace, pid)] = product_id
+                continue
+
+            self.add(
+                ProductState(
+                    product_id=product_id,
+                    pid=pid,
+                    marketplace=marketplace,
+                    info=latest[Info][product_id],
+                    launch=latest[Launch][product_id],
+                    availability=latest[Availability][product_id],
+                    prev_availability=prev_availability.get(product_id),
+                    timestamp=timestamps[product_id],
+                )
+            )
+        self.max_product_id = max_product_id
+        self.max_event_id = max(
+            self.max_event_id,
+            session.execute(select(func.max(ChangeEvent.id))).scalar() or 0,
+            session.execute(select(func.max(Subscriber.cursor))).scalar() or 0,
+        )
+        self.loaded = True
+
+        if self.incomplete:
+            sys.stdout.write(
+                f"skipped {len(self.incomplete)} products with missing rows:"
+                f" {sorted(self.incomplete.values())}\n"
+            )
+        if orphans:
+            sys.stdout.write(f"skipped rows of {len(orphans)} missing products: {sorted(orphans)}\n")
+
+    def check(self, session: Session) -> list[str]:
+        """
+        check verifies the mirror against the database.
+
+        returns:
+        a description of every difference, [] if there are none.
+        """
+        db = StateMirror()
+        db.load(session)
+
+        errors = []
+        for key in self.products.keys() - db.products.keys():
+            errors.append(f"{key}: only in mirror")
+        for key in db.products.keys() - self.products.keys():
+            errors.append(f"{key}: only in database")
+
+        for key in self.products.keys() & db.products.keys():
+            m, d = self.products[key], db.products[key]
+            for field in ProductState.__slots__:
+                if getattr(m, field) != getattr(d, field):
+                    errors.append(f"{key}: {field} differs:\n{getattr(m, field)}\n{getattr(d, field)}")
+
+        return errors
+
+
+state_mirror = StateMirror()
+
+
+if __name__ == "__main__":
+    from database import get_session
+
+    t0 = time.perf_counter()
+    with get_session() as session:
+        state_mirror.load(session)
+    sys.stdout.write(f"loaded {len(state_mirror.products)} products in {time.perf_counter() - t0:.3f}s\n")
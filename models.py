@@ -1,31 +1,30 @@
-import time
+import json
 from typing import Any
-from sqlalchemy import Column, Boolean, Integer, String, ForeignKey
+from sqlalchemy import Column, Boolean, Float, Integer, String, ForeignKey, Index
+from sqlalchemy import inspect, text
+from sqlalchemy.engine import Engine
 from sqlalchemy.orm import relationship
-from database import Base, engine
+from database import Base, get_engine
+from parse import InfoState, LaunchState, AvailabilityState
+
+
+# availability of products that are no longer in the feed.
+DISCONTINUED = AvailabilityState(False, None, None, None, None, None, None, None)
 
 
 class Product(Base):
     __tablename__: str = "products"
+    __table_args__ = (Index("ix_products_pid_marketplace", "pid", "marketplace", unique=True),)
 
     id = Column(Integer, primary_key=True, index=True)
-    pid = Column(Integer, unique=True, index=True, nullable=False)
+    pid = Column(Integer, index=True, nullable=False)
+    marketplace = Column(String, nullable=False, server_default="FR")
     info = relationship("Info", back_populates="product")
     launch = relationship("Launch", back_populates="product")
     availability = relationship("Availability", back_populates="product")
 
     def __repr__(self):
-        return f"id: {self.id}, pid: {self.pid}, info ({len(self.info)}), launch ({len(self.launch)}), availability ({len(self.availability)})"
-
-    @classmethod
-    def from_dict(cls, x: dict[str, Any]):
-        """ create a new Product instance from a key value mapping of all relevant data fields. """
-        return cls(
-            info=[Info.from_dict(x)],
-            pid=x["pid"],
-            launch=[Launch.from_dict(x)],
-            availability=[Availability.from_dict(x)],
-        )
+        return f"id: {self.id}, pid: {self.pid}, marketplace: {self.marketplace}, info ({len(self.info)}), launch ({len(self.launch)}), availability ({len(self.availability)})"
 
 
 class Info(Base):
@@ -48,38 +47,15 @@ class Info(Base):
     product = relationship("Product", back_populates="info")
 
     def __eq__(self, other) -> bool:
-        return all(
-            (
-                self.uid == other.uid,
-                self.title == other.title,
-                self.title_alt == other.title_alt,
-                self.brand == other.brand,
-                self.style_color == other.style_color,
-                self.product_type == other.product_type,
-                self.countries == other.countries,
-                self.genders == other.genders,
-                self.im_url == other.im_url,
-            )
-        )
-
-    @classmethod
-    def from_dict(cls, x: dict[str, Any]):
-        return cls(
-            uid=x["id"],
-            title=x["title"],
-            title_alt=x["title_alt"],
-            brand=x["brand"],
-            style_color=x["styleColor"],
-            product_type=x["productType"],
-            countries=x["countries"],
-            genders=x["genders"],
-            im_url=x["im_url"],
-            timestamp=int(time.time()),
-        )
+        return self.state() == other.state()
+
+    def state(self) -> InfoState:
+        return InfoState(*(getattr(self, k) for k in InfoState._fields))
 
 
 class Launch(Base):
     __tablename__: str = "launch"
+    __table_args__ = (Index("ix_launch_product_id_timestamp", "product_id", "timestamp"),)
 
     id = Column(Integer, primary_key=True, index=True)
 
@@ -102,44 +78,15 @@ class Launch(Base):
     product = relationship("Product", back_populates="launch")
 
     def __eq__(self, other) -> bool:
-        return all(
-            (
-                self.publish_type == other.publish_type,
-                self.method == other.method,
-                self.hard_launch == other.hard_launch,
-                self.quantity_limit == other.quantity_limit,
-                self.exclusive_access == other.exclusive_access,
-
-                self.modification_date == other.modification_date,
-                self.commerce_start_date == other.commerce_start_date,
-                self.commerce_end_date == other.commerce_end_date,
-                self.commerce_publish_date == other.commerce_publish_date,
-                self.soft_launch_date == other.soft_launch_date,
-                self.start_entry_date == other.start_entry_date,
-            )
-        )
-
-    @classmethod
-    def from_dict(cls, x: dict[str, Any]):
-        return cls(
-            publish_type=x["publishType"],
-            method=x["method"],
-            hard_launch=x["hardLaunch"],
-            quantity_limit=x["quantityLimit"],
-            exclusive_access=x["exclusiveAccess"],
-
-            modification_date=x["modificationDate"],
-            commerce_start_date=x["commerceStartDate"],
-            commerce_end_date=x["commerceEndDate"],
-            commerce_publish_date=x["commercePublishDate"],
-            soft_launch_date=x["softLaunchDate"],
-            start_entry_date=x["start_entry_date"],
-            timestamp=int(time.time()),
-        )
+        return self.state() == other.state()
+
+    def state(self) -> LaunchState:
+        return LaunchState(*(getattr(self, k) for k in LaunchState._fields))
 
 
 class Availability(Base):
     __tablename__: str = "availability"
+    __table_args__ = (Index("ix_availability_product_id_timestamp", "product_id", "timestamp"),)
 
     id = Column(Integer, primary_key=True, index=True)
     included_in_last_update = Column(Boolean, nullable=False)
@@ -158,43 +105,169 @@ class Availability(Base):
     product = relationship("Product", back_populates="availability")
 
     def __eq__(self, other) -> bool:
-        # if self.restricted != other.restricted:
-        # import sys
-        # sys.stdout.write(f"\n{type(self.restricted)}, {type(other.restricted)} -> {self.restricted}, {other.restricted}\n")
-        # pass
-
-        return all(
-            (
-                self.included_in_last_update == other.included_in_last_update,
-                self.available == other.available,
-                self.status == other.status,
-                self.avail_skus == other.avail_skus,
-                self.hide_from_csr == other.hide_from_csr,
-                self.hide_from_search == other.hide_from_search,
-                self.hide_from_upcoming == other.hide_from_upcoming,
-                self.restricted == other.restricted,
-            )
-        )
-
-    @classmethod
-    def from_dict(cls, x: dict[str, Any]):
-        return cls(
-            included_in_last_update = True,
-            available=x["available"],
-            status=x["status"],
-            avail_skus=x["avail_skus"],
-            hide_from_csr=x["hideFromCSR"],
-            hide_from_search=x["hideFromSearch"],
-            hide_from_upcoming=x["hide_from_upcoming"],
-            restricted=x["restricted"],
-            timestamp=int(time.time()),
-        )
-
-    @classmethod
-    def from_scratch(cls):
-        return cls(
-            included_in_last_update = False,
-            timestamp=int(time.time()),
-        )
-
-Base.metadata.create_all(bind=engine)
+        return self.state() == other.state()
+
+    def state(self) -> AvailabilityState:
+        return AvailabilityState(*(getattr(self, k) for k in AvailabilityState._fields))
+
+
+class Subscriber(Base):
+    __tablename__: str = "subscribers"
+
+    id = Column(Integer, primary_key=True, index=True)
+    chat_id = Column(Integer, unique=True, index=True, nullable=False)
+    active = Column(Boolean, nullable=False)
+    marketplaces = Column(String)
+    # id of the last ChangeEvent the chat has been notified about.
+    cursor = Column(Integer, nullable=False, server_default="0")
+
+    timestamp = Column(Integer)
+
+    watches = relationship("Watch", back_populates="subscriber")
+
+    def __repr__(self):
+        return f"id: {self.id}, chat_id: {self.chat_id}, active: {self.active}, watches ({len(self.watches)})"
+
+    def marketplace_list(self) -> list[str]:
+        """ returns: the marketplaces the chat is notified about, [] for all. """
+        return json.loads(self.marketplaces) if self.marketplaces else []
+
+
+class Watch(Base):
+    __tablename__: str = "watches"
+
+    id = Column(Integer, primary_key=True, index=True)
+    style_color = Column(String, index=True, nullable=False)
+    sizes = Column(String)
+    include_restricted = Column(Boolean)
+    comment = Column(String)
+    # the chat opts out of the shared (watchlist.json) entry of style_color.
+    excluded = Column(Boolean, nullable=False, server_default="0")
+
+    timestamp = Column(Integer)
+
+    subscriber_id = Column(Integer, ForeignKey("subscribers.id"), nullable=False)
+    subscriber = relationship("Subscriber", back_populates="watches")
+
+    def to_dict(self) -> dict[str, Any]:
+        """ same format as an entry in watchlist.json """
+        return {
+            "sizes": json.loads(self.sizes) if self.sizes else [],
+            "include_restricted": bool(self.include_restricted),
+            "comment": self.comment or "",
+            "excluded": bool(self.excluded),
+        }
+
+
+class ChangeEvent(Base):
+    """
+    An append-only log of product changes, one event per product whose
+    state changed in a crawl cycle. Ids are assigned by the state mirror
+    and only ever increase (see StateMirror.next_event_id), so a
+    subscriber's position in the log is the id of the last event it has
+    been notified about (its cursor), and catching up is a range scan over
+    the primary key.
+
+    state is the product's ProductState right after the change, as json
+    (see ProductState.to_json), so that notifications can be computed and
+    formatted long after the fact.
+    """
+    __tablename__: str = "change_events"
+    __table_args__ = {"sqlite_autoincrement": True}
+
+    id = Column(Integer, primary_key=True)
+    # json list of the kinds of change, see transactions.CHANGE_KINDS.
+    kinds = Column(String, nullable=False)
+    state = Column(String, nullable=False)
+
+    timestamp = Column(Integer)
+
+    product_id = Column(Integer, ForeignKey("products.id"), nullable=False)
+
+    def kind_list(self) -> list[str]:
+        return json.loads(self.kinds)
+
+
+class Lease(Base):
+    """
+    A lease held by one process at a time, e.g. leadership of the crawler
+    workers (see shard.py). It has to be renewed before it expires, after
+    which any other process can take it over. epoch is incremented
+    whenever the owner changes, it fences off the writes of previous
+    owners (see shard.lease_fence).
+    """
+    __tablename__: str = "leases"
+
+    name = Column(String, primary_key=True)
+    owner = Column(String, nullable=False)
+    expires = Column(Float, nullable=False)
+    epoch = Column(Integer, nullable=False, server_default="0")
+
+
+class CrawlCycle(Base):
+    """a crawl cycle started by the leader of the crawler workers."""
+    __tablename__: str = "crawl_cycles"
+
+    id = Column(Integer, primary_key=True)
+    timestamp = Column(Integer)
+
+
+class CrawlPage(Base):
+    """
+    A feed page crawled and parsed by a worker (see shard.py), or the
+    error crawling it raised. products is a json list of
+    ParsedProduct.to_list().
+    """
+    __tablename__: str = "crawl_pages"
+    __table_args__ = (Index("ix_crawl_pages_cycle_id_marketplace", "cycle_id", "marketplace"),)
+
+    id = Column(Integer, primary_key=True)
+    marketplace = Column(String, nullable=False)
+    anchor = Column(Integer, nullable=False)
+    worker = Column(String)
+    products = Column(String)
+    error = Column(String)
+
+    timestamp = Column(Integer)
+
+    cycle_id = Column(Integer, ForeignKey("crawl_cycles.id"), nullable=False)
+
+
+def init_db():
+    """
+    creates missing tables and migrates existing ones. This is an explicit
+    step (e.g. at the start of main), importing models has no side effects.
+    """
+    engine = get_engine()
+    Base.metadata.create_all(bind=engine)
+    migrate(engine)
+
+
+def migrate(engine: Engine):
+    """
+    create_all skips existing tables, so columns and indexes that were added
+    to a model later have to be added to existing databases here.
+    """
+    inspector = inspect(engine)
+
+    with engine.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            existing = set(c["name"] for c in inspector.get_columns(table.name))
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+
+                ddl = f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column.type.compile(engine.dialect)}"
+                if column.server_default is not None:
+                    ddl += f" NOT NULL DEFAULT '{column.server_default.arg}'"
+                conn.execute(text(ddl))
+
+        # pid used to be unique, now (pid, marketplace) is.
+        pid_index = [i for i in inspector.get_indexes("products") if i["name"] == "ix_products_pid"]
+        if pid_index and pid_index[0]["unique"]:
+            conn.execute(text("DROP INDEX ix_products_pid"))
+
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(bind=engine, checkfirst=True)
+
@@ -1,30 +1,92 @@
+import sys
 import math
 import json
 
+from dataclasses import dataclass
 from datetime import datetime, timedelta
-from typing import Any
-
-MERCH_KEYS = [
-    "brand",
-    "publishType",
-    "modificationDate",
-    "commercePublishDate",
-    "commerceStartDate",
-    "commerceEndDate",
-    "softLaunchDate",
-    "exclusiveAccess",
-    "hardLaunch",
-    "status",
-    "id",
-    "styleColor",
-    "quantityLimit",
-    "hideFromCSR",
-    "hideFromSearch",
-    "productType",
-    "pid",
-    "genders",
-    "im_url",
-]
+from typing import Any, NamedTuple, Optional
+
+
+class InfoState(NamedTuple):
+    """the values of an Info row that are compared to detect changes."""
+    uid: str
+    title: str
+    title_alt: str
+    brand: str
+    style_color: str
+    product_type: str
+    countries: str
+    genders: str
+    im_url: str
+
+
+class LaunchState(NamedTuple):
+    """the values of a Launch row that are compared to detect changes."""
+    publish_type: str
+    method: Optional[str]
+    hard_launch: bool
+    quantity_limit: int
+    exclusive_access: bool
+
+    modification_date: Optional[int]
+    commerce_start_date: Optional[int]
+    commerce_end_date: Optional[int]
+    commerce_publish_date: Optional[int]
+    soft_launch_date: Optional[int]
+    start_entry_date: Optional[int]
+
+
+class AvailabilityState(NamedTuple):
+    """the values of an Availability row that are compared to detect changes."""
+    included_in_last_update: bool
+    available: Optional[bool]
+    status: Optional[str]
+    avail_skus: Optional[str]
+    hide_from_csr: Optional[bool]
+    hide_from_search: Optional[bool]
+    hide_from_upcoming: Optional[str]
+    restricted: Optional[bool]
+
+
+@dataclass(slots=True)
+class ParsedProduct:
+    """
+    A product as parsed from nike's feed. Field names of the states match
+    the columns of the corresponding models, so that states can be compared
+    with Info/Launch/Availability rows without creating ORM objects.
+
+    Json encoded fields (countries, genders, avail_skus, hide_from_upcoming)
+    are encoded once, while parsing. Enum-like strings are interned, so that
+    all products share the same string objects.
+    """
+    pid: int
+    marketplace: str
+    info: InfoState
+    launch: LaunchState
+    availability: AvailabilityState
+
+    def to_list(self) -> list:
+        """a json serializable form, see from_list."""
+        return [self.pid, self.marketplace, list(self.info), list(self.launch), list(self.availability)]
+
+    @classmethod
+    def from_list(cls, x: list) -> "ParsedProduct":
+        pid, marketplace, info, launch, availability = x
+        info, launch, availability = InfoState(*info), LaunchState(*launch), AvailabilityState(*availability)
+        # intern the same strings as parse_info.
+        return cls(
+            pid=pid,
+            marketplace=sys.intern(marketplace),
+            info=info._replace(
+                brand=intern(info.brand),
+                product_type=intern(info.product_type),
+                countries=intern(info.countries),
+                genders=intern(info.genders),
+            ),
+            launch=launch._replace(publish_type=intern(launch.publish_type), method=intern(launch.method)),
+            availability=availability._replace(status=intern(availability.status)),
+        )
+
 
 # Nike time strings are in UTC time. Need to now diff to get accurate timestamp.
 time_delta = datetime.now() - datetime.utcnow()
@@ -32,24 +94,35 @@ time_delta = timedelta(minutes = math.ceil(time_delta.seconds / 60))
 
 def parse_nike_time(time_str: str) -> int:
     """
-    Nike time strings are in UTC time. This needs to be accounted for 
+    Nike time strings are in UTC time. This needs to be accounted for
     when server time is different. Returns timestamp in seconds.
     """
     dt = datetime.strptime(time_str[:-1], "%Y-%m-%dT%H:%M:%S.%f")
     return int((dt + time_delta).timestamp())
 
 
-def parse_launchView(info: dict[str, Any]) -> dict[str, Any]:
+def parse_optional_time(time_str: Optional[str]) -> Optional[int]:
+    return parse_nike_time(time_str) if time_str is not None else None
+
+
+def intern(s: Optional[str]) -> Optional[str]:
+    return sys.intern(s) if s is not None else None
+
+
+def parse_launchView(info: dict[str, Any]) -> tuple[Optional[int], Optional[str]]:
     """
     launch View is only available when publish type is "LAUNCH"
     rather than "FLOW".
+
+    returns:
+    (start_entry_date, method)
     """
     lv = info.get("launchView")
     if lv is None:
-        return {"start_entry_date": None, "method": None}
+        return None, None
 
     ts = parse_nike_time(lv["startEntryDate"])
-    return {"start_entry_date": ts, "method": lv["method"]}
+    return ts, intern(lv["method"])
 
 
 def parse_available_skus(info: dict[str, Any]) -> dict[str, str]:
@@ -59,39 +132,62 @@ def parse_available_skus(info: dict[str, Any]) -> dict[str, str]:
     if available_skus is None or skus is None:
         return {}
 
-    return {k["nikeSize"]: v["level"] for k, v in zip(skus, available_skus)}
-
-def parse_content_info(content_info: dict[str, Any]) -> dict[str, Any]:
-    hide_from_upcoming = content_info["properties"]["custom"].get("hideFromUpcoming")
-    hide_from_upcoming = json.dumps(hide_from_upcoming) if hide_from_upcoming else None
-    return {
-            "restricted": content_info["properties"]["custom"].get("restricted"),
-            "hide_from_upcoming": hide_from_upcoming,
-            "countries": json.dumps(content_info["properties"]["publish"]["countries"]),
-            "title_alt": content_info["properties"]["title"],
-    }
+    return {k["nikeSize"]: sys.intern(v["level"]) for k, v in zip(skus, available_skus)}
 
 
-def parse_info(content_info: dict[str, Any], product_info: dict[str, Any]):
+def parse_info(
+    content_info: dict[str, Any], product_info: dict[str, Any], marketplace: str = "FR"
+) -> ParsedProduct:
     mp = product_info["merchProduct"]
+    properties = content_info["properties"]
+    custom = properties["custom"]
 
-    info = {k: mp.get(k) for k in MERCH_KEYS}
-    info["genders"] = json.dumps(info["genders"])
+    hide_from_upcoming = custom.get("hideFromUpcoming")
+    hide_from_upcoming = json.dumps(hide_from_upcoming) if hide_from_upcoming else None
 
-    info.update(
-        {
-            k: parse_nike_time(v)
-            for k, v in info.items()
-            if "Date" in k and v is not None
-        }
+    info = InfoState(
+        uid=mp.get("id"),
+        title=product_info["productContent"]["title"],
+        title_alt=properties["title"],
+        brand=intern(mp.get("brand")),
+        style_color=mp.get("styleColor"),
+        product_type=intern(mp.get("productType")),
+        # few distinct values shared by many products.
+        countries=sys.intern(json.dumps(properties["publish"]["countries"])),
+        genders=sys.intern(json.dumps(mp.get("genders"))),
+        im_url=product_info["imageUrls"]["productImageUrl"],
     )
-    info.update(parse_launchView(product_info))
-    info.update(parse_content_info(content_info))
 
-    info["title"] = product_info["productContent"]["title"]
-    info["available"] = product_info["availability"]["available"]
-    info["im_url"] = product_info["imageUrls"]["productImageUrl"]
+    start_entry_date, method = parse_launchView(product_info)
+    launch = LaunchState(
+        publish_type=intern(mp.get("publishType")),
+        method=method,
+        hard_launch=mp.get("hardLaunch"),
+        quantity_limit=mp.get("quantityLimit"),
+        exclusive_access=mp.get("exclusiveAccess"),
+        modification_date=parse_optional_time(mp.get("modificationDate")),
+        commerce_start_date=parse_optional_time(mp.get("commerceStartDate")),
+        commerce_end_date=parse_optional_time(mp.get("commerceEndDate")),
+        commerce_publish_date=parse_optional_time(mp.get("commercePublishDate")),
+        soft_launch_date=parse_optional_time(mp.get("softLaunchDate")),
+        start_entry_date=start_entry_date,
+    )
 
-    info["avail_skus"] = json.dumps(parse_available_skus(product_info))
+    availability = AvailabilityState(
+        included_in_last_update=True,
+        available=product_info["availability"]["available"],
+        status=intern(mp.get("status")),
+        avail_skus=json.dumps(parse_available_skus(product_info)),
+        hide_from_csr=mp.get("hideFromCSR"),
+        hide_from_search=mp.get("hideFromSearch"),
+        hide_from_upcoming=hide_from_upcoming,
+        restricted=custom.get("restricted"),
+    )
 
-    return info
+    return ParsedProduct(
+        pid=int(mp["pid"]),
+        marketplace=sys.intern(marketplace),
+        info=info,
+        launch=launch,
+        availability=availability,
+    )
@@ -0,0 +1,281 @@
+"""
+The crawl cycle as a pipeline of stages connected by bounded queues:
+
+    fetch -> parse -> diff -> write-behind queue -> change-event delivery
+
+Products flow through parse and diff as soon as their page arrives,
+instead of waiting for the whole feed. Each stage is a single task, so
+items are handled in order and state_mirror is only touched by the diff
+stage. A full queue blocks the stage that feeds it (backpressure). The diff
+stage appends ChangeEvents to the rows it writes, and publishes them to the
+notifier right away: notifications don't wait for the database (see
+tgram.deliver_events).
+
+The next cycle is fetched while the tail of the current one (its last
+pages, discontinued products) is still being processed.
+At most two cycles are in flight: a cycle is fetched only once the one
+before the previous has completed.
+
+Messages are (cycle, marketplace, payload) tuples. The payload of a page
+is a list; None ends a marketplace's feed, an exception ends it with an
+error. A message whose marketplace is None ends the cycle.
+"""
+
+import sys
+import time
+import asyncio
+
+from datetime import datetime
+from dataclasses import dataclass, field
+from typing import Any, AsyncIterator, Callable, Optional
+
+from crawl import iter_pages, MARKETPLACES
+from database import get_session
+from parse import parse_info
+from mirror import state_mirror
+from models import ChangeEvent
+from transactions import update_products, handle_discontinued_products, new_changes
+from writer import write_queue
+from profiling import profiler
+
+# (content_info, product_info) tuples of a page, see crawl.page_infos.
+Page = list[tuple[dict[str, Any], dict[str, Any]]]
+
+# notified at the end of every cycle, see tgram.ping_loop. Without the
+# crawler, main.poll_database notifies it instead.
+cycle_done = asyncio.Condition()
+
+
+@dataclass
+class Cycle:
+    number: int
+    start: float = field(default_factory=time.perf_counter)
+    # set once all pages have been fetched.
+    fetched: asyncio.Event = field(default_factory=asyncio.Event)
+    # set once the cycle has been diffed and reported.
+    done: asyncio.Event = field(default_factory=asyncio.Event)
+    errors: dict[str, Exception] = field(default_factory=dict)
+    # pids seen per marketplace, to find discontinued products.
+    seen: dict[str, set[int]] = field(default_factory=dict)
+    all_changes: dict[str, list[int]] = field(default_factory=new_changes)
+
+
+async def check_mirror(notifier):
+    """
+    verifies state_mirror against the database. On mismatch, the admin is
+    notified and the mirror is reloaded from the database.
+    """
+    await write_queue.flush()
+    with get_session() as session:
+        errors = state_mirror.check(session)
+        if not errors:
+            return
+
+        state_mirror.load(session)
+
+    text = f"state mirror out of sync ({len(errors)} differences):\n" + "\n".join(errors[:10])
+    sys.stdout.write(f"\n{text}\n")
+    await notifier.dispatch_to_admin(text)
+
+
+class Pipeline:
+    """
+    notifier is either the tgram module or a main.ConsoleNotifier.
+
+    pages(cycle, marketplace) yields the pages of a marketplace's feed; by
+    default the feed is crawled, see crawl.iter_pages. If parsed is set,
+    pages are lists of ParsedProducts (see shard.py) instead of
+    (content_info, product_info) tuples.
+
+    check: verify the state mirror against the database after each cycle.
+    It is verified (and reloaded) anyway after write_queue has dropped rows.
+    """
+
+    def __init__(
+        self,
+        notifier,
+        marketplaces: list[str] = MARKETPLACES,
+        pages: Optional[Callable[[int, str], AsyncIterator[Page]]] = None,
+        parsed: bool = False,
+        check: bool = False,
+        throttle_sec: float = 10,
+        throttle_sec_on_error: float = 60,
+        max_concurrency: int = 4,
+        queue_size: int = 8,
+    ):
+        self.notifier = notifier
+        self.marketplaces = marketplaces
+        self.pages = pages
+        self.parsed = parsed
+        self.check = check
+        self.throttle_sec = throttle_sec
+        self.throttle_sec_on_error = throttle_sec_on_error
+        self.max_concurrency = max_concurrency
+        # write_queue.dropped as of the last check_mirror.
+        self.dropped = write_queue.dropped
+
+        self.page_queue: asyncio.Queue = asyncio.Queue(queue_size)
+        self.product_queue: asyncio.Queue = asyncio.Queue(queue_size)
+
+    async def run(self, cycles: Optional[int] = None):
+        """
+        runs cycles, forever if cycles is None. Raises if a stage stops,
+        which only happens on a bug, instead of waiting on its queue forever.
+        """
+        stages = [asyncio.ensure_future(s) for s in (self.parse(), self.diff())]
+        tasks: list[asyncio.Task] = []
+        try:
+            n = 0
+            while cycles is None or n < cycles:
+                cycle = Cycle(n)
+                tasks.append(asyncio.ensure_future(self.run_cycle(cycle)))
+                await self.wait(cycle.fetched.wait(), stages)
+                if len(tasks) > 1:
+                    await self.wait(tasks.pop(0), stages)
+
+                n += 1
+                if cycles is None or n < cycles:
+                    failed = len(cycle.errors) == len(self.marketplaces)
+                    await asyncio.sleep(self.throttle_sec_on_error if failed else self.throttle_sec)
+
+            for task in tasks:
+                await self.wait(task, stages)
+        finally:
+            for task in stages + tasks:
+                task.cancel()
+
+    @staticmethod
+    async def wait(aw, stages: list[asyncio.Task]):
+        """awaits aw, raising the error of any stage that stops meanwhile."""
+        task = asyncio.ensure_future(aw)
+        try:
+            done, _ = await asyncio.wait([task, *stages], return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            if not task.done():
+                task.cancel()
+        if task in done:
+            return task.result()
+
+        stage = done.pop()
+        raise RuntimeError(f"pipeline stage stopped: {stage.get_coro().__qualname__}") from stage.exception()
+
+    async def run_cycle(self, cycle: Cycle):
+        with profiler.cycle() as reports:
+            await self.fetch(cycle)
+            await cycle.done.wait()
+
+        if reports:
+            sys.stdout.write(f"\nprofile written to {reports[0]}\n")
+            if profiler.remaining == 0:
+                await self.notifier.dispatch_to_admin(f"profiling done, last report: {reports[0]}")
+
+    async def fetch(self, cycle: Cycle):
+        """fetch stage: puts the pages of all marketplaces, then ends the cycle."""
+        if self.pages is not None:
+            await self.fetch_marketplaces(cycle, self.pages)
+        else:
+            import aiohttp
+
+            async with aiohttp.ClientSession() as session:
+                await self.fetch_marketplaces(
+                    cycle,
+                    lambda _, marketplace: iter_pages(
+                        session, marketplace, asyncio.Semaphore(self.max_concurrency)
+                    ),
+                )
+
+        cycle.fetched.set()
+        await self.page_queue.put((cycle, None, None))
+
+    async def fetch_marketplaces(self, cycle: Cycle, pages: Callable[[int, str], AsyncIterator[Page]]):
+        async def fetch_marketplace(marketplace: str):
+            try:
+                async for page in pages(cycle.number, marketplace):
+                    await self.page_queue.put((cycle, marketplace, page))
+            except Exception as e:
+                cycle.errors[marketplace] = e
+                await self.page_queue.put((cycle, marketplace, e))
+            else:
+                await self.page_queue.put((cycle, marketplace, None))
+
+        await asyncio.gather(*[fetch_marketplace(m) for m in self.marketplaces])
+
+    async def parse(self):
+        """parse stage: turns pages into ParsedProducts."""
+        while True:
+            cycle, marketplace, payload = await self.page_queue.get()
+            if isinstance(payload, list) and not self.parsed:
+                try:
+                    payload = [parse_info(*info, marketplace) for info in payload]
+                except Exception as e:
+                    cycle.errors[marketplace] = e
+                    payload = e
+            await self.product_queue.put((cycle, marketplace, payload))
+
+    async def diff(self):
+        """
+        diff stage: diffs products against state_mirror and queues the rows
+        (including change events) for writing.
+        """
+        while True:
+            cycle, marketplace, payload = await self.product_queue.get()
+            if marketplace is None:
+                # a dropped batch leaves the mirror ahead of the database.
+                try:
+                    if self.check or write_queue.dropped > self.dropped:
+                        await check_mirror(self.notifier)
+                        self.dropped = write_queue.dropped
+                except Exception as e:
+                    sys.stdout.write(f"\nfailed to check the state mirror:\n{e}\n")
+                asyncio.ensure_future(self.end_cycle(cycle))
+                continue
+
+            try:
+                seen = cycle.seen.setdefault(marketplace, set())
+                if isinstance(payload, list):
+                    changes, rows = update_products(payload, state_mirror, seen)
+                elif payload is None:
+                    if marketplace in cycle.errors:
+                        # without the full feed, we can't tell what was discontinued:
+                        # a page failed to parse or diff. A feed that failed to crawl
+                        # ends with its error instead, skipped below.
+                        continue
+                    changes, rows = new_changes(), []
+                    changes["discontinued"], rows = handle_discontinued_products(
+                        list(seen), marketplace, state_mirror
+                    )
+                else:
+                    continue
+
+                for k, v in changes.items():
+                    cycle.all_changes[k] += v
+                await write_queue.put(rows)
+                # after the rows, so that cursors are written after their events.
+                self.notifier.publish_events([values for model, values in rows if model is ChangeEvent])
+            except Exception as e:
+                cycle.errors[marketplace] = e
+
+    async def end_cycle(self, cycle: Cycle):
+        """reports the cycle's changes and errors."""
+        try:
+            all_changes = cycle.all_changes
+            if any(all_changes.values()):
+                sys.stdout.write("\n" + " || ".join([f"{k}: {v}" for k , v in all_changes.items()]) + "\n")
+
+            sys.stdout.write(
+                f'{datetime.now().strftime("%H:%M:%S")}: cycle {cycle.number}'
+                f" took {time.perf_counter() - cycle.start:.3f} seconds.\n"
+            )
+            sys.stdout.flush()
+
+            async with cycle_done:
+                cycle_done.notify_all()
+
+            if cycle.errors:
+                await self.notifier.dispatch_to_admin(
+                    "failed to crawl:\n" + "\n".join(f"{k}: {v}" for k, v in cycle.errors.items())
+                )
+        except Exception as e:
+            sys.stdout.write(f"\nreceived error:\n{e}\n")
+        finally:
+            cycle.done.set()
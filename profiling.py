@@ -0,0 +1,176 @@
+"""
+Opt-in profiling of crawl cycles. profiler.request(n) arms the profiler
+for the next n cycles (see Pipeline.run_cycle), either from the /profile admin
+command or by sending SIGUSR1 to the process.
+
+For each profiled cycle a report is written to PROFILE_DIR: the cProfile
+stats sorted by cumulative time, followed by every SQL statement executed
+during the cycle with its count and total time, so that N+1 patterns show
+up as one statement executed many times. The raw stats are dumped next to
+it (.prof) for snakeviz/pstats. Only the newest max_reports cycles are kept.
+"""
+
+import os
+import io
+import sys
+import time
+import pstats
+import cProfile
+import threading
+
+from datetime import datetime
+from contextlib import contextmanager
+from typing import Optional
+
+PROFILE_DIR = os.path.join(os.path.dirname(__file__), "profiles")
+
+
+class StatementStats:
+    """
+    counts and times SQL statements of all engines while active. Statements
+    executed by the write-behind queue run in a worker thread, hence the lock.
+    """
+
+    def __init__(self):
+        from sqlalchemy import event
+        from sqlalchemy.engine import Engine
+
+        self.active = False
+        self.lock = threading.Lock()
+        # statement -> [count, total seconds]
+        self.stats: dict[str, list] = {}
+        event.listen(Engine, "before_cursor_execute", self.before_cursor_execute)
+        event.listen(Engine, "after_cursor_execute", self.after_cursor_execute)
+
+    def before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        if self.active:
+            conn.info.setdefault("query_start_time", []).append(time.perf_counter())
+
+    def after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        start_times = conn.info.get("query_start_time")
+        if not self.active or not start_times:
+            return
+
+        elapsed = time.perf_counter() - start_times.pop()
+        with self.lock:
+            entry = self.stats.setdefault(statement, [0, 0.0])
+            entry[0] += 1
+            entry[1] += elapsed
+
+    def start(self):
+        self.stats = {}
+        self.active = True
+
+    def stop(self) -> dict[str, list]:
+        self.active = False
+        with self.lock:
+            return self.stats
+
+    @staticmethod
+    def format(stats: dict[str, list]) -> str:
+        n = sum(count for count, _ in stats.values())
+        total = sum(seconds for _, seconds in stats.values())
+        lines = [f"{n} statements in {total * 1000:.1f} ms, {len(stats)} distinct:"]
+        for statement, (count, seconds) in sorted(stats.items(), key=lambda x: -x[1][1]):
+            statement = " ".join(statement.split())
+            lines.append(f"{count:6}x {seconds * 1000:10.1f} ms  {statement}")
+        return "\n".join(lines)
+
+
+class Profiler:
+    """
+    Profiler profiles the next `remaining` cycles. Each profiled cycle is
+    wrapped in cycle(), which writes a report when the cycle is done.
+
+    cProfile measures the event loop thread only, so other tasks that run
+    while the cycle awaits (e.g. bot commands) show up too; the database
+    writes of the write-behind queue are counted in the SQL statistics but
+    not in the cProfile stats.
+    """
+
+    def __init__(self, out_dir: str = PROFILE_DIR, max_reports: int = 20):
+        self.out_dir = out_dir
+        self.max_reports = max_reports
+        self.remaining = 0
+        self.active = False
+        self.statements: Optional[StatementStats] = None
+
+    def request(self, n: int = 1):
+        """profile the next n cycles (n = 0 cancels)."""
+        self.remaining = n
+
+    @contextmanager
+    def cycle(self):
+        """
+        profiles the enclosed cycle if requested, yields a list that
+        receives the path of the report, if one was written.
+        """
+        reports = []
+        # cycles of the pipeline overlap, only one of them is profiled at a time.
+        if self.remaining <= 0 or self.active:
+            yield reports
+            return
+
+        self.active = True
+        self.remaining -= 1
+        if self.statements is None:
+            self.statements = StatementStats()
+
+        profile = cProfile.Profile()
+        self.statements.start()
+        t0 = time.perf_counter()
+        profile.enable()
+        try:
+            yield reports
+        finally:
+            profile.disable()
+            self.active = False
+            elapsed = time.perf_counter() - t0
+            statements = self.statements.stop()
+            reports.append(self.write_report(profile, statements, elapsed))
+
+    def write_report(self, profile: cProfile.Profile, statements: dict[str, list], elapsed: float) -> str:
+        """returns: the path of the report."""
+        os.makedirs(self.out_dir, exist_ok=True)
+        name = datetime.now().strftime("cycle-%Y%m%d-%H%M%S-%f")
+        path = os.path.join(self.out_dir, f"{name}.txt")
+
+        s = io.StringIO()
+        s.write(f"cycle took {elapsed:.3f} s\n\n")
+        s.write(StatementStats.format(statements) + "\n\n")
+        pstats.Stats(profile, stream=s).sort_stats("cumulative").print_stats(50)
+
+        with open(path, "w") as f:
+            f.write(s.getvalue())
+        profile.dump_stats(os.path.join(self.out_dir, f"{name}.prof"))
+
+        self.rotate()
+        return path
+
+    def rotate(self):
+        """deletes all but the newest max_reports reports."""
+        names = sorted(
+            os.path.splitext(f)[0] for f in os.listdir(self.out_dir) if f.endswith(".txt")
+        )
+        for name in names[:-self.max_reports]:
+            for ext in (".txt", ".prof"):
+                try:
+                    os.remove(os.path.join(self.out_dir, name + ext))
+                except FileNotFoundError:
+                    pass
+
+
+profiler = Profiler()
+
+
+def install_signal_handler(loop, n: int = 3):
+    """SIGUSR1 profiles the next n cycles (not available on windows)."""
+    import signal
+
+    if hasattr(signal, "SIGUSR1"):
+        loop.add_signal_handler(signal.SIGUSR1, profiler.request, n)
+
+
+if __name__ == "__main__":
+    # summarizes a report's raw stats, e.g. python profiling.py profiles/cycle-....prof
+    pstats.Stats(sys.argv[1]).sort_stats(sys.argv[2] if len(sys.argv) > 2 else "cumulative").print_stats(30)
@@ -1,14 +1,15 @@
 import json
-from typing import Optional
+from typing import Iterable, Optional, Union
 from datetime import datetime
-from sqlalchemy.orm import Session
+from sqlalchemy.orm import Session, selectinload
 from sqlalchemy import func
 
 from utils import flatten
-from models import Product, Launch, Info, Availability
+from models import Product, Launch, Info, Availability, Subscriber, Watch, ChangeEvent, CrawlCycle
+from parse import LaunchState, AvailabilityState
 
 
-def has_size(avail: Availability, sizes: list[str]):
+def has_size(avail: Union[Availability, AvailabilityState], sizes: list[str]):
     """returns True if at least one size in sizes is available"""
     avail_skus = avail.avail_skus
 
@@ -29,11 +30,26 @@ def is_available(
     if len(p.availability) < abs(idx):
         return False
 
-    avail = p.availability[idx]
+    return is_state_available(p.availability[idx], p.launch[-1], sizes, restricted)
+
+
+def is_state_available(
+    avail: Optional[Union[Availability, AvailabilityState]],
+    l: Union[Launch, LaunchState],
+    sizes: list[str] = [],
+    restricted: bool = False,
+):
+    """
+    same as is_available, but for a single availability and launch, which
+    can be either rows or states (see mirror.ProductState).
+    """
+    if avail is None:
+        return False
+
     if sizes and not has_size(avail, sizes):
         return False
 
-    launch_date = get_launch_date(p)
+    launch_date = get_launch_date_of(l)
     return all(
         [
             avail.status == "ACTIVE",
@@ -60,7 +76,10 @@ def get_launch_date(p: Product) -> datetime:
     returns:
     the relevant date.
     """
-    l: Launch = p.launch[-1]
+    return get_launch_date_of(p.launch[-1])
+
+
+def get_launch_date_of(l: Union[Launch, LaunchState]) -> datetime:
     ts = l.start_entry_date or l.commerce_start_date
     assert isinstance(ts, int)
     return datetime.fromtimestamp(ts)
@@ -74,7 +93,10 @@ def get_launch_method(p: Product) -> str:
     returns:
     either "LEO", "DAN", or "FLOW"
     """
-    l: Launch = p.launch[-1]
+    return get_launch_method_of(p.launch[-1])
+
+
+def get_launch_method_of(l: Union[Launch, LaunchState]) -> str:
     method = l.method or l.publish_type
     # method = method or ""
     assert isinstance(method, str)
@@ -92,8 +114,20 @@ def filter_hidden_products(products: list[Product]) -> list[Product]:
     return [p for p in products if p.info[-1].style_color in hidden]
 
 
+def query_products_loaded(session: Session):
+    """
+    a Product query that loads info, launch and availability up front,
+    with one query per relationship instead of three per product.
+    """
+    return session.query(Product).options(
+        selectinload(Product.info),
+        selectinload(Product.launch),
+        selectinload(Product.availability),
+    )
+
+
 def query_all_available_products(session: Session) -> list[Product]:
-    products: list[Product] = session.query(Product).all()
+    products: list[Product] = query_products_loaded(session).all()
     products = [p for p in products if p.info[-1].product_type == "FOOTWEAR"]
     products = [p for p in products if is_available(p, restricted=False)]
     return products
@@ -101,7 +135,7 @@ def query_all_available_products(session: Session) -> list[Product]:
 
 def query_restricted_products(session: Session) -> list[Product]:
     """restricted is not necessarily the same as exclusive assess"""
-    products: list[Product] = session.query(Product).all()
+    products: list[Product] = query_products_loaded(session).all()
     products = [p for p in products if is_available(p, restricted=True)]
     return products
 
@@ -112,11 +146,27 @@ def query_hidden_products(session: Session) -> list[Product]:
     return products
 
 
-def query_product_by_product_id(session: Session, product_id: int) -> Product:
-    product = session.query(Product).filter(Product.id == product_id).first()
-    assert product is not None
+def query_products_by_product_ids(
+    session: Session, product_ids: Iterable[int]
+) -> dict[int, Product]:
+    """
+    fetches all products in product_ids with a single products query (plus
+    one query per relationship, see query_products_loaded).
 
-    return product
+    returns:
+    a mapping of product_id (Product.id) to product. product_ids that do
+    not exist are missing from the mapping.
+    """
+    product_ids = set(product_ids)
+    if not product_ids:
+        return {}
+
+    products = query_products_loaded(session).filter(Product.id.in_(product_ids)).all()
+    return {p.id: p for p in products}
+
+
+def query_product_by_product_id(session: Session, product_id: int) -> Optional[Product]:
+    return query_products_by_product_ids(session, [product_id]).get(product_id)
 
 
 def query_product_by_style_color(
@@ -149,20 +199,77 @@ def query_products_by_style_color(
     return product
 
 
+def query_active_subscribers(session: Session) -> list[Subscriber]:
+    return session.query(Subscriber).filter(Subscriber.active == True).all()
+
+
+def query_events(session: Session, after_id: int, limit: int) -> list[ChangeEvent]:
+    """
+    returns:
+    the first limit change events with an id greater than after_id, in
+    order. This is a range scan over the primary key.
+    """
+    return (
+        session.query(ChangeEvent)
+        .filter(ChangeEvent.id > after_id)
+        .order_by(ChangeEvent.id)
+        .limit(limit)
+        .all()
+    )
+
+
+def query_event_product_ids(session: Session, after_id: int) -> list[tuple[int, int]]:
+    """
+    returns:
+    (id, product_id) of every change event with an id greater than
+    after_id, in order.
+    """
+    return (
+        session.query(ChangeEvent.id, ChangeEvent.product_id)
+        .filter(ChangeEvent.id > after_id)
+        .order_by(ChangeEvent.id)
+        .all()
+    )
+
+
+def query_last_event_id(session: Session) -> int:
+    return session.query(func.coalesce(func.max(ChangeEvent.id), 0)).scalar()
+
+
+def query_last_crawl_cycle_id(session: Session) -> int:
+    return session.query(func.coalesce(func.max(CrawlCycle.id), 0)).scalar()
+
+
+def query_watches(session: Session) -> list[tuple[int, Watch]]:
+    """
+    returns:
+    a list of (chat_id, watch) tuples for every watch in the database.
+    """
+    return (
+        session.query(Subscriber.chat_id, Watch)
+        .join(Watch, Watch.subscriber_id == Subscriber.id)
+        .all()
+    )
+
+
 if __name__ == "__main__":
     from database import get_session
-    from watchlist import should_notify
+    from watchlist import WatchlistIndex, should_notify, SHARED
+    from mirror import state_mirror
     from utils import read_json
 
-    watchlist = read_json("watchlist.json")
+    index = WatchlistIndex()
+    index.load_shared(read_json("watchlist.json"))
 
     sku = "DM0807-400"
-    all_changes = {"add": [], "launch": [], "discontinued": [], "availability": [13]}
 
     with get_session() as session:
-        notify = should_notify(session, watchlist, all_changes)
-        print("notification list: ", notify)
+        state_mirror.load(session)
+
+    notify = should_notify([state_mirror.by_id[13]], index, {SHARED: []})
+    print("notification list: ", notify)
 
+    # with get_session() as session:
         # p = query_product_by_product_id(session, 13)
         # avail = is_available(p, idx=-6, sizes=[])
         # name = p.info[-1].title
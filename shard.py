@@ -0,0 +1,377 @@
+"""
+Sharded crawling: the (marketplace, anchor) pages of every cycle are
+partitioned across COUNT worker processes, which coordinate through the
+database.
+
+usage: python cli.py worker INDEX COUNT [--marketplace ...]
+
+Every worker polls for new crawl cycles (CrawlCycle), crawls and parses
+its share of the pages (see shard_units) and stores them as CrawlPages.
+
+One of the workers holds the leader lease (Lease), which it renews every
+lease_sec / 3. The leader starts the cycles and runs the crawl pipeline
+with the pages of all workers as its source (see leader_pages): pages
+are diffed as they arrive, and handle_discontinued_products runs on the
+merged pids of a marketplace once all of its pages have arrived. A
+marketplace with a failed or missing page (e.g. its worker is down) is
+not checked for discontinued products in that cycle, as if a page had
+failed to crawl in a single process.
+
+The leader is the only process that diffs and writes products, so the
+product ids assigned by its state mirror stay unique. A worker that
+becomes leader loads the mirror from the database. Every write of the
+leader checks, in its transaction, that the lease is still in the epoch
+the leader took it in (see lease_fence): a leader that stalled past
+lease_sec and was replaced can't write anymore, not even a batch that
+was already being committed. A worker that loses the lease stops, and
+its pending writes are rejected into the write queue's dead-letter file.
+A product's rows are always written or rejected together, so the next
+leader never loads a half-written product.
+
+All workers must be started with the same marketplaces and COUNT, and
+their clocks must agree to well within lease_sec. Notifications are sent
+by the bot process (cli.py run --no-crawl), from the change events the
+leader writes.
+"""
+
+import os
+import sys
+import json
+import time
+import socket
+import asyncio
+
+from typing import Any, AsyncIterator, Callable, Optional, TypeVar
+from sqlalchemy import select, insert, update, delete, case, text
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import Session
+
+from crawl import get_page, page_infos, ANCHORS, MARKETPLACES
+from database import get_engine, get_session
+from models import init_db, Lease, CrawlCycle, CrawlPage
+from parse import parse_info, ParsedProduct
+from queries import query_last_crawl_cycle_id
+from writer import write_queue
+
+LEADER_LEASE = "crawl-leader"
+
+T = TypeVar("T")
+
+
+def in_session(f: Callable[..., T], *args) -> T:
+    """
+    runs f(session, *args) in a session of its own. Called with
+    asyncio.to_thread, so that a locked database (e.g. while another
+    worker writes) blocks a thread rather than the event loop.
+    """
+    with get_session() as session:
+        return f(session, *args)
+
+
+def shard_units(marketplaces: list[str], index: int, count: int) -> list[tuple[str, int]]:
+    """returns: the (marketplace, anchor) pages crawled by worker index of count."""
+    units = [(marketplace, anchor) for marketplace in marketplaces for anchor in ANCHORS]
+    return units[index::count]
+
+
+class LeaseLost(Exception):
+    pass
+
+
+def acquire_lease(session: Session, name: str, owner: str, lease_sec: float) -> Optional[int]:
+    """
+    takes or renews lease name for owner, unless another owner holds it
+    and it has not expired. Taking over a lease starts a new epoch.
+
+    returns:
+    the epoch of the lease if owner holds it for the next lease_sec
+    seconds, else None.
+    """
+    now = time.time()
+    session.execute(
+        sqlite_insert(Lease).values(name=name, owner=owner, expires=0, epoch=0).on_conflict_do_nothing()
+    )
+    res = session.execute(
+        update(Lease)
+        .where(Lease.name == name, (Lease.owner == owner) | (Lease.expires < now))
+        .values(
+            owner=owner,
+            expires=now + lease_sec,
+            epoch=case((Lease.owner == owner, Lease.epoch), else_=Lease.epoch + 1),
+        )
+    )
+    epoch = session.execute(select(Lease.epoch).where(Lease.name == name)).scalar()
+    session.commit()
+    return epoch if res.rowcount == 1 else None
+
+
+def lease_fence(name: str, owner: str, epoch: int) -> Callable[[Session], None]:
+    """
+    returns:
+    a fence for write_rows that raises LeaseLost unless owner still holds
+    lease name in epoch. A no-op update takes the database's write lock,
+    so that the lease can't change hands before the rows are committed.
+    """
+    def fence(session: Session):
+        res = session.execute(
+            update(Lease)
+            .where(Lease.name == name, Lease.owner == owner, Lease.epoch == epoch)
+            .values(epoch=epoch)
+        )
+        if res.rowcount != 1:
+            raise LeaseLost(f"{owner} no longer holds {name} in epoch {epoch}")
+
+    return fence
+
+
+def release_lease(session: Session, name: str, owner: str):
+    session.execute(
+        update(Lease).where(Lease.name == name, Lease.owner == owner).values(expires=0)
+    )
+    session.commit()
+
+
+def start_cycle(session: Session, fence: Optional[Callable[[Session], None]] = None) -> int:
+    """
+    starts a crawl cycle, and deletes the pages of all cycles but the
+    previous one. fence is run first, as in write_rows.
+
+    returns:
+    the id of the cycle.
+    """
+    if fence is not None:
+        fence(session)
+    cycle_id = session.execute(insert(CrawlCycle).values(timestamp=int(time.time()))).inserted_primary_key[0]
+    session.execute(delete(CrawlPage).where(CrawlPage.cycle_id < cycle_id - 1))
+    session.execute(delete(CrawlCycle).where(CrawlCycle.id < cycle_id - 1))
+    session.commit()
+    return cycle_id
+
+
+def store_page(session: Session, values: dict[str, Any]):
+    session.execute(insert(CrawlPage).values(**values))
+    session.commit()
+
+
+def query_pages(session: Session, cycle_id: int, marketplace: str, after_id: int) -> list[tuple]:
+    """
+    returns:
+    (id, anchor, products, error) of the pages of marketplace in cycle_id
+    with an id greater than after_id, in order.
+    """
+    return session.execute(
+        select(CrawlPage.id, CrawlPage.anchor, CrawlPage.products, CrawlPage.error)
+        .where(
+            CrawlPage.cycle_id == cycle_id,
+            CrawlPage.marketplace == marketplace,
+            CrawlPage.id > after_id,
+        )
+        .order_by(CrawlPage.id)
+    ).all()
+
+
+async def crawl_shard(cycle_id: int, units: list[tuple[str, int]], worker: str, max_concurrency: int = 4):
+    """crawls and parses the pages in units, and stores them as CrawlPages."""
+    import aiohttp
+
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def crawl_unit(session: aiohttp.ClientSession, marketplace: str, anchor: int):
+        values: dict[str, Any] = {"products": None, "error": None}
+        try:
+            async with semaphore:
+                page = await get_page(session, marketplace, anchor)
+            products = [parse_info(*info, marketplace).to_list() for info in page_infos(page)]
+            values["products"] = json.dumps(products)
+        except Exception as e:
+            values["error"] = repr(e)
+
+        values.update(
+            cycle_id=cycle_id,
+            marketplace=marketplace,
+            anchor=anchor,
+            worker=worker,
+            timestamp=int(time.time()),
+        )
+        try:
+            await asyncio.to_thread(in_session, store_page, values)
+        except Exception as e:
+            # the leader times out waiting for the page.
+            sys.stdout.write(f"failed to store page {marketplace} {anchor} of cycle {cycle_id}:\n{e}\n")
+
+    async with aiohttp.ClientSession() as session:
+        await asyncio.gather(*[crawl_unit(session, m, a) for m, a in units])
+
+
+async def crawl_loop(units: list[tuple[str, int]], worker: str, poll_sec: float = 1):
+    """crawls units of every new cycle; cycles started while busy are skipped."""
+    last_cycle_id = 0
+    while True:
+        try:
+            cycle_id = await asyncio.to_thread(in_session, query_last_crawl_cycle_id)
+        except Exception as e:
+            # e.g. database is locked, try again with the next poll.
+            sys.stdout.write(f"failed to poll for crawl cycles:\n{e}\n")
+            cycle_id = None
+
+        if cycle_id and cycle_id > last_cycle_id:
+            last_cycle_id = cycle_id
+            t0 = time.perf_counter()
+            await crawl_shard(cycle_id, units, worker)
+            sys.stdout.write(f"crawled {len(units)} pages of cycle {cycle_id} in {time.perf_counter() - t0:.3f} s\n")
+        else:
+            await asyncio.sleep(poll_sec)
+
+
+def leader_pages(poll_sec: float = 0.5, timeout_sec: float = 60):
+    """
+    returns:
+    the pages source of the leader's pipeline: pages(cycle, marketplace)
+    yields the parsed pages of marketplace as workers store them. It
+    raises once all pages have arrived if any of them failed, or if pages
+    are still missing after timeout_sec.
+    """
+    # the task that starts the crawl cycle of each pipeline cycle. If it
+    # fails, every marketplace of the cycle fails with it, instead of
+    # starting another crawl cycle.
+    cycle_ids: dict[int, asyncio.Task] = {}
+
+    async def pages(cycle: int, marketplace: str) -> AsyncIterator[list[ParsedProduct]]:
+        # the first marketplace of a pipeline cycle starts the crawl cycle.
+        if cycle not in cycle_ids:
+            cycle_ids.pop(cycle - 2, None)
+            task = asyncio.ensure_future(asyncio.to_thread(in_session, start_cycle, write_queue.fence))
+            # its error is raised by the marketplaces awaiting it, if any are left.
+            task.add_done_callback(lambda t: t.cancelled() or t.exception())
+            cycle_ids[cycle] = task
+        # shielded, so that a cancelled marketplace does not cancel the others.
+        cycle_id = await asyncio.shield(cycle_ids[cycle])
+
+        anchors: set[int] = set()
+        errors: list[str] = []
+        last_id = 0
+        deadline = time.monotonic() + timeout_sec
+        while len(anchors) < len(ANCHORS):
+            rows = await asyncio.to_thread(in_session, query_pages, cycle_id, marketplace, last_id)
+
+            for id, anchor, products, error in rows:
+                last_id = id
+                # pages crawled by more than one worker count once.
+                if anchor in anchors:
+                    continue
+                anchors.add(anchor)
+
+                if error is not None:
+                    errors.append(f"anchor {anchor}: {error}")
+                else:
+                    yield [ParsedProduct.from_list(x) for x in json.loads(products)]
+
+            if not rows:
+                if time.monotonic() > deadline:
+                    missing = sorted(set(ANCHORS) - anchors)
+                    raise TimeoutError(f"anchors {missing} were not crawled in time")
+                await asyncio.sleep(poll_sec)
+
+        if errors:
+            raise RuntimeError("\n".join(errors))
+
+    return pages
+
+
+async def lead(notifier, marketplaces: list[str], check: bool = False):
+    """runs the leader's pipeline, see leader_pages."""
+    import main
+    from pipeline import Pipeline
+
+    main.setup()
+    write_queue.start()
+    pipeline = Pipeline(notifier, marketplaces, pages=leader_pages(), parsed=True, check=check)
+    await pipeline.run()
+
+
+async def run_worker(
+    index: int,
+    count: int,
+    marketplaces: list[str] = MARKETPLACES,
+    check: bool = False,
+    lease_sec: float = 30,
+):
+    """
+    runs worker index of count, which crawls its share of the pages, and
+    leads the workers whenever it holds the leader lease.
+    """
+    import main
+
+    worker = f"{socket.gethostname()}:{os.getpid()}:{index}/{count}"
+    units = shard_units(marketplaces, index, count)
+    sys.stdout.write(f"worker {worker}: {len(units)} pages per cycle\n")
+
+    # workers started together race to create the tables.
+    for attempt in range(5):
+        try:
+            init_db()
+            break
+        except OperationalError as e:
+            if attempt == 4:
+                raise
+            sys.stdout.write(f"worker {worker}: failed to create the tables, retrying:\n{e}\n")
+            await asyncio.sleep(1)
+
+    # lets the leader read while workers write.
+    with get_engine().connect() as conn:
+        conn.execute(text("PRAGMA journal_mode=WAL"))
+
+    crawler = asyncio.ensure_future(crawl_loop(units, worker))
+    leader: Optional[asyncio.Task] = None
+    epoch: Optional[int] = None
+
+    async def stop_leading():
+        """
+        stops the leader's pipeline and writes the rows it has queued. The
+        state mirror already reflects them, so they are not discarded: if
+        another worker has taken over meanwhile, the fence rejects them
+        and the write queue keeps them in its dead-letter file.
+        """
+        leader.cancel()
+        await asyncio.gather(leader, return_exceptions=True)
+        await write_queue.close()
+
+    try:
+        while True:
+            if crawler.done():
+                # a worker that does not crawl must not hold on to the lease either.
+                raise RuntimeError(f"worker {worker}: crawler stopped") from crawler.exception()
+
+            try:
+                epoch_ = await asyncio.to_thread(in_session, acquire_lease, LEADER_LEASE, worker, lease_sec)
+            except Exception as e:
+                sys.stdout.write(f"worker {worker}: failed to renew the leader lease:\n{e}\n")
+                await asyncio.sleep(lease_sec / 3)
+                continue
+
+            if leader is not None and epoch_ != epoch:
+                # another worker has taken over, possibly giving the lease back since.
+                sys.stdout.write(f"worker {worker}: lost the leader lease\n")
+                await stop_leading()
+                leader = None
+
+            if leader is not None and leader.done():
+                # the pipeline only stops on errors, let another worker lead.
+                sys.stdout.write(f"worker {worker}: leader stopped:\n{leader.exception()}\n")
+                await stop_leading()
+                leader = None
+                await asyncio.to_thread(in_session, release_lease, LEADER_LEASE, worker)
+            elif epoch_ is not None and leader is None:
+                sys.stdout.write(f"worker {worker}: leading in epoch {epoch_}\n")
+                epoch = epoch_
+                write_queue.fence = lease_fence(LEADER_LEASE, worker, epoch)
+                # lead loads the state mirror from the database.
+                leader = asyncio.ensure_future(lead(main.ConsoleNotifier(), marketplaces, check))
+
+            await asyncio.sleep(lease_sec / 3)
+    finally:
+        crawler.cancel()
+        if leader is not None:
+            await stop_leading()
+            await asyncio.to_thread(in_session, release_lease, LEADER_LEASE, worker)
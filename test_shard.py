@@ -0,0 +1,149 @@
+"""
+A leader that loses its lease in the middle of a write stream, and the
+leader that takes over (see shard.py). Run with pytest.
+"""
+
+import json
+import asyncio
+
+import pytest
+
+import database
+
+
+def raw(i: int, available: bool = True) -> tuple[dict, dict]:
+    """returns: a (content_info, product_info) tuple as in nike's feed, see crawl.page_infos."""
+    content = {
+        "properties": {
+            "custom": {"restricted": False, "hideFromUpcoming": None},
+            "publish": {"countries": ["FR"]},
+            "title": f"alt {i}",
+        }
+    }
+    product = {
+        "merchProduct": {
+            "brand": "Nike", "publishType": "FLOW", "modificationDate": "2022-06-01T10:00:00.000Z",
+            "commercePublishDate": "2022-06-01T10:00:00.000Z", "commerceStartDate": "2022-06-01T10:00:00.000Z",
+            "commerceEndDate": None, "softLaunchDate": None, "exclusiveAccess": False, "hardLaunch": False,
+            "status": "ACTIVE", "id": f"uid-{i}", "styleColor": f"SC{i:04d}-001", "quantityLimit": 1,
+            "hideFromCSR": False, "hideFromSearch": False, "productType": "FOOTWEAR", "pid": str(1000 + i),
+            "genders": ["MEN"],
+        },
+        "productContent": {"title": f"Shoe {i}"},
+        "availability": {"available": available},
+        "imageUrls": {"productImageUrl": f"https://img/{i}.jpg"},
+        "skus": [{"nikeSize": s} for s in ["9", "10", "11"]],
+        "availableSkus": [{"level": "HIGH"} for _ in range(3)],
+    }
+    return content, product
+
+
+def parsed(ids, available: bool = True):
+    from parse import parse_info
+
+    return [parse_info(*raw(i, available), "FR") for i in ids]
+
+
+@pytest.fixture(autouse=True)
+def db(tmp_path, monkeypatch):
+    monkeypatch.setattr(database, "_engine", None)
+    database.set_database_url(f"sqlite:///{tmp_path / 'snkrs.db'}")
+
+    from models import init_db
+
+    init_db()
+    yield
+    database.get_engine().dispose()
+
+
+def test_new_leader_after_fence_mid_stream(tmp_path):
+    from database import get_session
+    from mirror import StateMirror
+    from transactions import update_products
+    from writer import WriteBehindQueue
+    from shard import LEADER_LEASE, LeaseLost, acquire_lease, release_lease, lease_fence
+
+    dead_letters = tmp_path / "failed_rows.jsonl"
+
+    async def lead(owner: str, mirror: StateMirror, batches: list[list[int]], take_over_after: int = -1):
+        with get_session() as session:
+            epoch = acquire_lease(session, LEADER_LEASE, owner, 60)
+        assert epoch is not None
+        fence = lease_fence(LEADER_LEASE, owner, epoch)
+
+        calls = 0
+
+        def fence_(session):
+            # another worker takes the lease while batches are still queued.
+            nonlocal calls
+            calls += 1
+            if calls == take_over_after + 1:
+                with get_session() as other:
+                    release_lease(other, LEADER_LEASE, owner)
+                    assert acquire_lease(other, LEADER_LEASE, "other", 60) is not None
+            fence(session)
+
+        # small batches, so that products end up in different batches.
+        queue = WriteBehindQueue(batch_size=3, max_delay_sec=0, dead_letter_path=str(dead_letters))
+        queue.fence = fence_
+        queue.start()
+        for ids in batches:
+            _, rows = update_products(parsed(ids), mirror, set())
+            await queue.put(rows)
+        await queue.close()
+        return queue
+
+    async def run():
+        old = await lead("old", StateMirror(), [list(range(10))], take_over_after=2)
+        assert old.dropped > 0
+        errors = [json.loads(line)["error"] for line in dead_letters.read_text().splitlines()]
+        assert errors and all(LeaseLost.__name__ in e for e in errors)
+
+        with get_session() as session:
+            release_lease(session, LEADER_LEASE, "other")
+            new = StateMirror()
+            new.load(session)
+        assert not new.incomplete
+        assert 0 < len(new.products) < 10
+
+        await lead("new", new, [list(range(10))])
+        assert len(new.products) == 10
+
+        with get_session() as session:
+            assert new.check(session) == []
+
+    asyncio.run(run())
+
+
+def test_load_skips_products_with_missing_rows():
+    from database import get_session
+    from mirror import StateMirror
+    from models import Product, Info
+    from transactions import update_products
+    from writer import write_rows, product_id
+
+    mirror = StateMirror()
+    _, rows = update_products(parsed([1, 2, 3]), mirror, set())
+    # product 1 without its state rows, the state rows of product 3 without its Product.
+    write_rows([
+        row for row in rows
+        if not (product_id(row) == 1 and row[0] is not Product)
+        and not (product_id(row) == 3 and row[0] is Product)
+    ])
+
+    loaded = StateMirror()
+    with get_session() as session:
+        loaded.load(session)
+    assert loaded.incomplete == {("FR", 1001): 1}
+    assert set(loaded.by_id) == {2}
+    assert loaded.max_product_id == 3
+
+    # product 1 keeps its id, the new product gets one past the orphaned rows.
+    changes, rows = update_products(parsed([1, 4]), loaded, set())
+    assert changes["add"] == [1, 4]
+    assert [model for model, _ in rows].count(Product) == 1
+    write_rows(rows)
+
+    with get_session() as session:
+        assert loaded.check(session) == []
+        assert session.query(Info).filter(Info.product_id == 1).count() == 1
@@ -1,80 +1,175 @@
+"""
+The telegram bot. telegram, aiohttp and the database layer are imported
+by the functions that use them, so that importing tgram stays cheap; they
+are loaded once the application is built (see get_application).
+"""
+
+import re
 import asyncio
 import json
-import telegram
-import telegram.constants
-
-from telegram import Update
-from telegram.ext import filters, ApplicationBuilder, ContextTypes
-from telegram.ext import CommandHandler, MessageHandler
+import statistics
 
-from utils import read_token, read_json
-from watchlist import should_notify
-from queries import get_launch_date, get_launch_method
-from models import Product
-from database import get_session
-from queries import query_all_available_products, query_hidden_products
-from queries import query_restricted_products, get_last_change_date
-from queries import query_product_by_product_id
+from collections import deque
+from datetime import datetime
+from typing import TYPE_CHECKING, Any, Optional
 
-token, admin_chat_id = read_token()
-print("GOT TOKEN")
+from utils import read_token
+from watchlist import WatchlistIndex, should_notify, SHARED
+from cache import query_cache
+from crawl import MARKETPLACE_LANGUAGES
+from profiling import profiler
+from images import image_cache
 
+if TYPE_CHECKING:
+    from telegram import Update
+    from telegram.ext import Application, ContextTypes
+    from models import Product
+    from mirror import ProductState
 
 class Subscription:
-    def __init__(self):
-        self.queue = asyncio.Queue()
-        self.watchlist = read_json("watchlist.json")
+    def __init__(self, marketplaces: Optional[list[str]] = None, cursor: int = 0):
+        self.marketplaces = list(marketplaces) if marketplaces is not None else []
+        # id of the last change event the chat has been notified about, ahead
+        # of Subscriber.cursor until the write queue has written it.
+        self.cursor = cursor
 
 
 subscriptions: dict[int, Subscription] = {}
+pid_pattern = re.compile(r"/pid_(\d+)")
+watchlist_index = WatchlistIndex()
+
+# set when change events have been detected or written, see delivery_loop.
+new_events = asyncio.Event()
+
+# (event id, state) of the change events that chats are notified about,
+# from detection until they have been written, see publish_events.
+pending_events: deque[tuple[int, "ProductState"]] = deque()
+
+# kinds of change that chats are notified about.
+NOTIFY_KINDS = {"availability", "add"}
 
 keyboard = [
     ["/subscribe", "/unsubscribe"],
     ["/available", "/hidden"],
     ["/exclusive_access", "/ping"],
+    ["/watchlist"],
 ]
 
-application = ApplicationBuilder().token(token).build()
+# created on first use, see get_application.
+_application: Optional["Application"] = None
+_admin_chat_id: Optional[str] = None
+
+
+def get_application() -> "Application":
+    """
+    returns:
+    the telegram application, which is built (and credentials are read)
+    on the first call.
+    """
+    from telegram.ext import ApplicationBuilder
+
+    global _application, _admin_chat_id
+    if _application is None:
+        token, _admin_chat_id = read_token()
+        print("GOT TOKEN")
+
+        _application = ApplicationBuilder().token(token).build()
+        for handler in get_handlers().values():
+            _application.add_handler(handler)
+
+    return _application
 
 
-def get_chat_id(update: Update) -> int:
+def get_chat_id(update: "Update") -> int:
     """utility to avoid lsp complaining"""
     assert update.effective_chat is not None
     return update.effective_chat.id
 
 
-def format_products_message(products: list[Product]) -> str:
+def load_subscriptions():
+    """restore subscriptions and watchlists from the database."""
+    from database import get_session
+    from queries import query_active_subscribers
+
+    with get_session() as session:
+        for sub in query_active_subscribers(session):
+            subscriptions[sub.chat_id] = Subscription(sub.marketplace_list(), sub.cursor)
+        watchlist_index.load_watches(session)
+
+
+def format_products_message(products: list["Product"]) -> str:
     html = ""
     for p in products:
         title = p.info[-1].title
-        html += f"\n<b>{title}</b> /pid_{p.id}"
+        html += f"\n<b>{title}</b> [{p.marketplace}] /pid_{p.id}"
     return html
 
 
-def format_product_message(p: Product) -> str:
-    html = f"<b>{p.info[-1].title}</b>"
-    html += f"\n(<i>{p.info[-1].style_color}</i>)"
-    html += f"\n{get_launch_method(p)}: {get_launch_date(p)}"
-    html += f"\nlast change: {get_last_change_date(p)}"
-    html += f'\n<a href="{p.info[-1].im_url}">url</a>'
+def format_product_message(p: "Product") -> str:
+    from queries import get_last_change_date
+
+    return format_snapshot_message(
+        p.info[-1], p.launch[-1], p.availability[-1], p.marketplace, get_last_change_date(p)
+    )
+
+
+def format_state_message(state: "ProductState") -> str:
+    return format_snapshot_message(
+        state.info,
+        state.launch,
+        state.availability,
+        state.marketplace,
+        datetime.fromtimestamp(state.timestamp),
+    )
+
+
+def format_snapshot_message(info, launch, availability, marketplace: str, last_change: datetime) -> str:
+    """info, launch and availability can be either rows or states."""
+    from queries import get_launch_date_of, get_launch_method_of
+
+    html = f"<b>{info.title}</b> [{marketplace}]"
+    html += f"\n(<i>{info.style_color}</i>)"
+    html += f"\n{get_launch_method_of(launch)}: {get_launch_date_of(launch)}"
+    html += f"\nlast change: {last_change}"
+    html += f'\n<a href="{info.im_url}">url</a>'
     html += "\n"
 
-    html += f"\navailable: {p.availability[-1].available}"
-    html += f"\nstatus: {p.availability[-1].status}"
+    html += f"\navailable: {availability.available}"
+    html += f"\nstatus: {availability.status}"
 
     html += f"\nskus:"
 
-    skus = json.loads(p.availability[-1].avail_skus)
+    # discontinued products have no skus.
+    skus = json.loads(availability.avail_skus or "{}")
     for k, v in skus.items():
         html += f"\n\t\t{k}: {v}"
 
     return html
 
 
+def split_message(texts: list[str], sep: str = "\n\n") -> list[str]:
+    """
+    joins texts into as few messages as possible without exceeding
+    telegram's message length limit. A single text is never split.
+    """
+    import telegram.constants
+
+    limit = telegram.constants.MessageLimit.TEXT_LENGTH
+
+    messages = []
+    for text in texts:
+        if messages and len(messages[-1]) + len(sep) + len(text) <= limit:
+            messages[-1] += sep + text
+        else:
+            messages.append(text)
+
+    return messages
+
+
 async def dispatch_to_admin(text: str):
     """genereric function to dispatch a message to the admin"""
-    bot = application.bot
-    await bot.send_message(chat_id=admin_chat_id, text=text)
+    bot = get_application().bot
+    await bot.send_message(chat_id=_admin_chat_id, text=text)
 
 
 # async def dispatch_notifications(text: str):
@@ -83,57 +178,409 @@ async def dispatch_to_admin(text: str):
 # await asyncio.gather(*[bot.send_message(chat_id = chat_id, text=text) for chat_id in subscriptions])
 
 
-async def dispatch_alarm(all_changes: dict[str, list[int]]):
-    bot = application.bot
+async def send_notification(bot, chat_id: int, state: "ProductState"):
+    """
+    sends the product's image with the notification as caption, see
+    images.py. Falls back to a text message if there is no image, the
+    caption is too long, or the image can't be downloaded, cached or
+    sent. Errors about the chat itself are raised, see deliver_events.
+    """
+    import aiohttp
+    import telegram.constants
+
+    text = "NOW AVAILABLE!\n" + format_state_message(state)
+    parse_mode = telegram.constants.ParseMode.HTML
+
+    url = state.info.im_url
+    if url and len(text) <= telegram.constants.MessageLimit.CAPTION_LENGTH:
+        try:
+            await image_cache.send_photo(bot, chat_id, url, caption=text, parse_mode=parse_mode)
+            return
+        except (aiohttp.ClientError, asyncio.TimeoutError, OSError) as e:
+            print(f"failed to download or cache {url}, sending text:\n{e}")
+        except telegram.error.BadRequest as e:
+            if is_chat_gone(e):
+                raise
+            print(f"failed to send photo {url}, sending text:\n{e}")
+            if is_bad_file_id(e):
+                # e.g. a file_id of another bot, upload again next time.
+                image_cache.file_ids.pop(url, None)
+
+    await bot.send_message(chat_id=chat_id, text=text, parse_mode=parse_mode)
+
+
+def is_transient(e: Exception) -> bool:
+    """returns: whether sending a message that raised e may succeed later."""
+    import telegram.error
+
+    # BadRequest is a NetworkError too, but sending it again fails the same way.
+    return isinstance(e, telegram.error.RetryAfter) or (
+        isinstance(e, telegram.error.NetworkError)
+        and not isinstance(e, telegram.error.BadRequest)
+    )
+
+
+def is_bad_file_id(e: Exception) -> bool:
+    """returns: whether e rejected the file_id of a photo, e.g. "Wrong file identifier/http url specified"."""
+    text = str(e).lower()
+    return "file identifier" in text or "file_id" in text or "file reference" in text
+
+
+def is_chat_gone(e: Exception) -> bool:
+    """returns: whether e means that the chat can't be messaged anymore."""
+    import telegram.error
+
+    # Forbidden: the bot was blocked or removed from the chat.
+    return isinstance(e, (telegram.error.Forbidden, telegram.error.ChatMigrated)) or (
+        isinstance(e, telegram.error.BadRequest) and "chat not found" in str(e).lower()
+    )
+
+
+def publish_events(events: list[dict[str, Any]]):
+    """
+    publish_events takes the values of ChangeEvent rows as soon as the
+    diff stage has detected them (see pipeline.py), so that chats are
+    notified without waiting for the write queue.
+    """
+    from mirror import ProductState
+
+    for event in events:
+        if NOTIFY_KINDS & set(json.loads(event["kinds"])):
+            pending_events.append((event["id"], ProductState.from_json(event["product_id"], event["state"])))
+    new_events.set()
+
+
+async def deliver_events(batch_size: int = 500):
+    """
+    deliver_events notifies every subscribed chat about the change events
+    after its cursor (see models.ChangeEvent), and advances the cursors.
+    Events that have been written are read from the database in batches of
+    batch_size, starting at the lowest cursor. Once those are exhausted,
+    pending_events follow, which have been detected but are still in the
+    write queue. Each batch is fanned out to all chats concurrently.
+
+    Cursors are advanced in memory (Subscription.cursor) and written
+    through the write queue, after the events they point past. After a
+    crash, a chat is notified again about the events after its written
+    cursor: delivery is at least once. Events that were delivered but
+    never written are lost, their ids are not reused (see
+    StateMirror.load).
+
+    A chat whose message fails with a transient error (network, flood
+    control) keeps its cursor before the failed event, so that it is
+    retried by the next call, and is skipped for the rest of this one. A
+    chat that blocked the bot or no longer exists is unsubscribed. Any
+    other error only skips the event, so that a single message that can't
+    be sent does not hold the chat back forever.
+    """
+    from database import get_session
+    from mirror import ProductState
+    from queries import query_events, query_last_event_id
+    from transactions import cursor_rows, set_subscribed
+    from writer import write_queue
+
+    bot = get_application().bot
+    failed: set[int] = set()
+
+    while True:
+        cursors = {chat_id: sub.cursor for chat_id, sub in subscriptions.items() if chat_id not in failed}
+        after_id = min(cursors.values(), default=0)
 
-    notifications = []
-    for chat_id, sub in subscriptions.items():
         with get_session() as session:
-            products = should_notify(session, sub.watchlist, all_changes)
-            notifications += [
-                "NOW AVAILABLE!\n" + format_product_message(p) for p in products
-            ]
+            written_id = query_last_event_id(session)
+            events = query_events(session, after_id, batch_size) if cursors else []
+
+        # pending events that have been written are read from the database.
+        while pending_events and pending_events[0][0] <= written_id:
+            pending_events.popleft()
+        if not cursors:
+            return
+
+        states = [
+            (event.id, ProductState.from_json(event.product_id, event.state))
+            for event in events
+            if NOTIFY_KINDS & set(event.kind_list())
+        ]
+        last_id = events[-1].id if events else after_id
+        if len(events) < batch_size:
+            states += [(event_id, state) for event_id, state in pending_events if event_id > last_id]
+            if states:
+                last_id = max(last_id, states[-1][0])
+        if last_id == after_id:
+            return
+
+        # download the images of watched products once, before the fan-out.
+        await image_cache.prefetch([
+            state.info.im_url
+            for _, state in states
+            if state.info.style_color in watchlist_index.entries
+            and state.info.im_url
+            and state.info.im_url not in image_cache.file_ids
+        ])
+
+        async def deliver(chat_id: int, cursor: int, marketplaces: list[str]) -> int:
+            """returns: the chat's new cursor."""
+            for event_id, state in states:
+                if event_id <= cursor or not should_notify([state], watchlist_index, {chat_id: marketplaces}):
+                    continue
+                try:
+                    await send_notification(bot, chat_id, state)
+                except Exception as e:
+                    if is_transient(e):
+                        print(f"failed to notify {chat_id}, retrying later:\n{e}")
+                        failed.add(chat_id)
+                        return event_id - 1
+                    if is_chat_gone(e):
+                        print(f"chat {chat_id} can't be notified anymore, unsubscribing it:\n{e}")
+                        gone.add(chat_id)
+                        break
+                    print(f"failed to notify {chat_id} of event {event_id}, skipping it:\n{e}")
+            return max(cursor, last_id)
+
+        gone: set[int] = set()
+        new_cursors = await asyncio.gather(*[
+            deliver(chat_id, cursor, subscriptions[chat_id].marketplaces)
+            for chat_id, cursor in cursors.items()
+        ])
+
+        advanced = {}
+        for (chat_id, old), new in zip(cursors.items(), new_cursors):
+            sub = subscriptions.get(chat_id)
+            if new != old and sub is not None:
+                sub.cursor = max(sub.cursor, new)
+                advanced[chat_id] = sub.cursor
+        await write_queue.put(cursor_rows(advanced))
+
+        if gone:
+            with get_session() as session:
+                for chat_id in gone:
+                    set_subscribed(session, chat_id, False)
+                    subscriptions.pop(chat_id, None)
+        failed |= gone
+
+
+async def delivery_loop(retry_sec: float = 60):
+    """
+    delivers change events whenever new ones have been detected or
+    written, and every retry_sec for chats that failed. Catches up right
+    away at startup.
+    """
+    new_events.set()
+    while True:
+        try:
+            await asyncio.wait_for(new_events.wait(), retry_sec)
+        except asyncio.TimeoutError:
+            pass
+        new_events.clear()
+
+        try:
+            await deliver_events()
+        except Exception as e:
+            print("failed to deliver change events:\n", e)
 
-        for text in notifications:
-            await bot.send_message(
-                chat_id=chat_id, text=text, parse_mode=telegram.constants.ParseMode.HTML
-            )
 
+async def start(update: "Update", context: "ContextTypes.DEFAULT_TYPE"):
+    import telegram
 
-async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     reply_markup = telegram.ReplyKeyboardMarkup(keyboard)
     await context.bot.send_message(
         chat_id=get_chat_id(update), text="HI", reply_markup=reply_markup
     )
 
 
-async def subscribe(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def subscribe(update: "Update", context: "ContextTypes.DEFAULT_TYPE"):
+    from database import get_session
+    from mirror import state_mirror
+    from transactions import set_subscribed
+
     chat_id = get_chat_id(update)
 
     text = "You are already subscribed!"
     if chat_id not in subscriptions:
         text = "You are now subscribed!"
-        subscriptions[chat_id] = Subscription()
+        # events still in the write queue happened before the chat subscribed
+        # too. Without the crawler in this process (cli.py run --no-crawl),
+        # the bot only knows about written events.
+        cursor = state_mirror.max_event_id if state_mirror.loaded else None
+        with get_session() as session:
+            sub = set_subscribed(session, chat_id, True, cursor)
+            subscriptions[chat_id] = Subscription(sub.marketplace_list(), sub.cursor)
         # subscriptions[chat_id] = asyncio.Queue()
 
     await context.bot.send_message(chat_id=chat_id, text=text)
 
 
-async def unsubscribe(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def unsubscribe(update: "Update", context: "ContextTypes.DEFAULT_TYPE"):
+    from database import get_session
+    from transactions import set_subscribed
+
     chat_id = get_chat_id(update)
 
     if chat_id in subscriptions:
+        with get_session() as session:
+            set_subscribed(session, chat_id, False)
         subscriptions.pop(chat_id)
 
     text = "you are unsubscribed"
     await context.bot.send_message(chat_id=chat_id, text=text)
 
 
-async def available(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def watch(update: "Update", context: "ContextTypes.DEFAULT_TYPE"):
+    """
+    /watch STYLE_COLOR [SIZE ...]
+    adds sizes to the chat's watch of STYLE_COLOR. Without sizes, any size
+    of STYLE_COLOR is watched. A watch of any size is not narrowed down to
+    some sizes, that takes an /unwatch first.
+    """
+    from database import get_session
+    from transactions import upsert_watch
+
+    chat_id = get_chat_id(update)
+    if chat_id not in subscriptions:
+        await context.bot.send_message(
+            chat_id=chat_id, text="you need to be subscribed to watch products"
+        )
+        return
+
+    if not context.args:
+        await context.bot.send_message(
+            chat_id=chat_id, text="usage: /watch STYLE_COLOR [SIZE ...]"
+        )
+        return
+
+    style_color, sizes = context.args[0].upper(), context.args[1:]
+    # the chat's own entry, or the shared one.
+    current = watchlist_index.watchlist(chat_id).get(style_color)
+    if current is not None and not current.get("sizes") and sizes:
+        text = f"you are already watching {style_color} in any size."
+        text += f"\nto watch only sizes {', '.join(sizes)}, /unwatch {style_color} first."
+        await context.bot.send_message(chat_id=chat_id, text=text)
+        return
+
+    entry = dict(current or {})
+    entry.setdefault("include_restricted", True)
+    entry["excluded"] = False
+    entry["sizes"] = sorted(set(entry.get("sizes", []) + sizes)) if sizes else []
+
     with get_session() as session:
-        products = query_all_available_products(session)
-        html = "available:" + format_products_message(products)
-        html += f"\ntotal available: {len(products)}"
+        upsert_watch(session, chat_id, style_color, entry)
+    watchlist_index.add(chat_id, style_color, entry)
+
+    text = f"watching {style_color}, sizes: {', '.join(entry['sizes']) or 'any'}"
+    await context.bot.send_message(chat_id=chat_id, text=text)
+
+
+async def unwatch(update: "Update", context: "ContextTypes.DEFAULT_TYPE"):
+    """
+    /unwatch STYLE_COLOR [SIZE ...]
+    removes sizes from the chat's watch of STYLE_COLOR. Without sizes, or
+    when no size is left, the watch is removed altogether. A shared
+    (watchlist.json) entry is replaced by an entry of the chat's own: with
+    the remaining sizes, or one that excludes STYLE_COLOR for this chat.
+    """
+    from database import get_session
+    from transactions import upsert_watch, remove_watch
+
+    chat_id = get_chat_id(update)
+    if not context.args:
+        await context.bot.send_message(
+            chat_id=chat_id, text="usage: /unwatch STYLE_COLOR [SIZE ...]"
+        )
+        return
+
+    style_color, sizes = context.args[0].upper(), context.args[1:]
+    chats = watchlist_index.entries.get(style_color, {})
+    entry = watchlist_index.watchlist(chat_id).get(style_color)
+    if entry is None:
+        await context.bot.send_message(
+            chat_id=chat_id, text=f"you are not watching {style_color}"
+        )
+        return
+
+    if sizes and not entry.get("sizes"):
+        text = f"you are watching {style_color} in any size, sizes can't be removed from that."
+        text += f"\nto stop watching it, /unwatch {style_color}"
+        await context.bot.send_message(chat_id=chat_id, text=text)
+        return
+
+    entry = dict(entry)
+    entry["sizes"] = [s for s in entry.get("sizes", []) if s not in sizes]
+
+    with get_session() as session:
+        if sizes and entry["sizes"]:
+            upsert_watch(session, chat_id, style_color, entry)
+            watchlist_index.add(chat_id, style_color, entry)
+            text = f"watching {style_color}, sizes: {', '.join(entry['sizes'])}"
+        elif SHARED in chats:
+            # removing the chat's own entry would bring the shared one back.
+            entry = {**entry, "sizes": [], "excluded": True}
+            upsert_watch(session, chat_id, style_color, entry)
+            watchlist_index.add(chat_id, style_color, entry)
+            text = f"stopped watching {style_color} (excluded from the shared watchlist)"
+        else:
+            remove_watch(session, chat_id, style_color)
+            watchlist_index.remove(chat_id, style_color)
+            text = f"stopped watching {style_color}"
+
+    await context.bot.send_message(chat_id=chat_id, text=text)
+
+
+async def marketplaces(update: "Update", context: "ContextTypes.DEFAULT_TYPE"):
+    """
+    /marketplaces [MARKETPLACE ...|all]
+    restricts notifications to the given marketplaces, or shows the current
+    selection when called without arguments.
+    """
+    from database import get_session
+    from transactions import set_marketplaces
+
+    chat_id = get_chat_id(update)
+    sub = subscriptions.get(chat_id)
+    if sub is None:
+        await context.bot.send_message(
+            chat_id=chat_id, text="you need to be subscribed to select marketplaces"
+        )
+        return
+
+    if context.args:
+        selection = [m.upper() for m in context.args if m.lower() != "all"]
+        unknown = [m for m in selection if m not in MARKETPLACE_LANGUAGES]
+        if unknown:
+            text = f"unknown marketplaces: {', '.join(unknown)}"
+            text += f"\nchoose from: {', '.join(MARKETPLACE_LANGUAGES)}"
+            await context.bot.send_message(chat_id=chat_id, text=text)
+            return
+
+        with get_session() as session:
+            set_marketplaces(session, chat_id, selection)
+        sub.marketplaces = selection
+
+    text = f"marketplaces: {', '.join(sub.marketplaces) or 'all'}"
+    await context.bot.send_message(chat_id=chat_id, text=text)
+
+
+async def show_watchlist(update: "Update", context: "ContextTypes.DEFAULT_TYPE"):
+    import telegram.constants
+
+    chat_id = get_chat_id(update)
+
+    html = "watchlist:"
+    for style_color, entry in sorted(watchlist_index.watchlist(chat_id).items()):
+        sizes = ", ".join(entry.get("sizes", [])) or "any"
+        html += f"\n<b>{style_color}</b> {entry.get('comment', '')} (<i>{sizes}</i>)"
+
+    await context.bot.send_message(
+        chat_id=chat_id, text=html, parse_mode=telegram.constants.ParseMode.HTML
+    )
+
+
+async def available(update: "Update", context: "ContextTypes.DEFAULT_TYPE"):
+    import telegram.constants
+    from queries import query_all_available_products
+
+    products = await query_cache.get(query_all_available_products)
+    html = "available:" + format_products_message(products)
+    html += f"\ntotal available: {len(products)}"
     await context.bot.send_message(
         chat_id=get_chat_id(update),
         text=html,
@@ -142,10 +589,12 @@ async def available(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
 
 
-async def hidden(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    with get_session() as session:
-        products = query_hidden_products(session)
-        html = "hidden_products: " + format_products_message(products)
+async def hidden(update: "Update", context: "ContextTypes.DEFAULT_TYPE"):
+    import telegram.constants
+    from queries import query_hidden_products
+
+    products = await query_cache.get(query_hidden_products)
+    html = "hidden_products: " + format_products_message(products)
     await context.bot.send_message(
         chat_id=get_chat_id(update),
         text=html,
@@ -154,10 +603,12 @@ async def hidden(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
 
 
-async def restricted(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    with get_session() as session:
-        products = query_restricted_products(session)
-        html = "exclusive access: " + format_products_message(products)
+async def restricted(update: "Update", context: "ContextTypes.DEFAULT_TYPE"):
+    import telegram.constants
+    from queries import query_restricted_products
+
+    products = await query_cache.get(query_restricted_products)
+    html = "exclusive access: " + format_products_message(products)
     await context.bot.send_message(
         chat_id=get_chat_id(update),
         text=html,
@@ -166,7 +617,103 @@ async def restricted(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
 
 
-async def send_product(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def get_style_color_product_ids(
+    update: "Update", context: "ContextTypes.DEFAULT_TYPE"
+) -> list[int]:
+    """
+    resolves the style_color argument of an analytics command to product_ids.
+    Replies with an error message and returns [] if that fails.
+    """
+    from analytics import query_product_ids_by_style_color
+
+    chat_id = get_chat_id(update)
+    if not context.args:
+        await context.bot.send_message(chat_id=chat_id, text="you must specify a style_color")
+        return []
+
+    style_color = context.args[0].upper()
+    product_ids = await query_cache.get(query_product_ids_by_style_color, style_color)
+    if not product_ids:
+        await context.bot.send_message(chat_id=chat_id, text=f"{style_color} not found")
+    return product_ids
+
+
+async def restocks(update: "Update", context: "ContextTypes.DEFAULT_TYPE"):
+    """/restocks STYLE_COLOR: restock count and cadence."""
+    import telegram.constants
+    from analytics import query_restocks, format_duration
+
+    product_ids = await get_style_color_product_ids(update, context)
+    if not product_ids:
+        return
+
+    product_restocks = await query_cache.get(query_restocks, tuple(product_ids))
+
+    html = f"restocks of {context.args[0].upper()}:"
+    for product_id in product_ids:
+        ts = product_restocks.get(product_id, [])
+        html += f"\n/pid_{product_id}: {len(ts)} restocks"
+        if len(ts) > 1:
+            intervals = [b - a for a, b in zip(ts, ts[1:])]
+            html += f", every {format_duration(statistics.median(intervals))} (median)"
+        if ts:
+            html += f"\n\t\tlast restock: {datetime.fromtimestamp(ts[-1])}"
+
+    await context.bot.send_message(
+        chat_id=get_chat_id(update), text=html, parse_mode=telegram.constants.ParseMode.HTML
+    )
+
+
+async def in_stock(update: "Update", context: "ContextTypes.DEFAULT_TYPE"):
+    """/instock STYLE_COLOR: total time in stock per size."""
+    import telegram.constants
+    from analytics import query_time_in_stock_by_size, format_duration
+
+    product_ids = await get_style_color_product_ids(update, context)
+    if not product_ids:
+        return
+
+    durations = await query_cache.get(query_time_in_stock_by_size, tuple(product_ids))
+
+    html = f"time in stock of {context.args[0].upper()}:"
+    for product_id in product_ids:
+        html += f"\n/pid_{product_id}:"
+        for size, seconds in durations.get(product_id, {}).items():
+            html += f"\n\t\t{size}: {format_duration(seconds)}"
+
+    await context.bot.send_message(
+        chat_id=get_chat_id(update), text=html, parse_mode=telegram.constants.ParseMode.HTML
+    )
+
+
+async def flaps(update: "Update", context: "ContextTypes.DEFAULT_TYPE"):
+    """/flaps: the products that dropped out of the feed most often."""
+    import telegram.constants
+    from analytics import query_flap_counts
+    from queries import query_products_by_product_ids
+
+    flap_counts = await query_cache.get(query_flap_counts, None, 20)
+    products = await query_cache.get(
+        query_products_by_product_ids, tuple(sorted(flap_counts))
+    )
+
+    html = "dropped out of feed:"
+    for product_id, count in flap_counts.items():
+        title = products[product_id].info[-1].title if product_id in products else ""
+        html += f"\n{count}x <b>{title}</b> /pid_{product_id}"
+
+    await context.bot.send_message(
+        chat_id=get_chat_id(update),
+        text=html,
+        parse_mode=telegram.constants.ParseMode.HTML,
+        disable_web_page_preview=True,
+    )
+
+
+async def send_product(update: "Update", context: "ContextTypes.DEFAULT_TYPE"):
+    import telegram.constants
+    from queries import query_products_by_product_ids
+
     chat_id = get_chat_id(update)
 
     if "/pid_" not in update.message.text:
@@ -175,30 +722,39 @@ async def send_product(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return
 
-    pid = update.message.text.replace("/pid_", "")
-    if not pid.isnumeric():
+    # a message may contain any number of /pid_N, e.g. "/pid_12 /pid_40".
+    pids = list(dict.fromkeys(int(pid) for pid in pid_pattern.findall(update.message.text)))
+    if not pids:
         await context.bot.send_message(
             chat_id=chat_id, text="you must specify a product_id"
         )
         return
 
-    with get_session() as session:
-        p = query_product_by_product_id(session, int(pid))
-        html = format_product_message(p)
-    await context.bot.send_message(
-        chat_id=chat_id, text=html, parse_mode=telegram.constants.ParseMode.HTML
+    products = await query_cache.get(
+        query_products_by_product_ids, tuple(sorted(pids)), depends_on=pids
     )
+    texts = [
+        format_product_message(products[pid])
+        if pid in products
+        else f"product {pid} not found"
+        for pid in pids
+    ]
+
+    for html in split_message(texts):
+        await context.bot.send_message(
+            chat_id=chat_id, text=html, parse_mode=telegram.constants.ParseMode.HTML
+        )
 
 
-async def ping_loop(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def ping_loop(update: "Update", context: "ContextTypes.DEFAULT_TYPE"):
     """
-    ping loop sends a message to the loop coroutine. As soon as the message
-    has been read, queue.join() will stop blocking and a "pong" message is
-    sent to the caller.
+    replies "pong" as soon as the crawler completes its next cycle, which
+    shows that it is still running.
     """
+    from pipeline import cycle_done
+
     chat_id = get_chat_id(update)
-    sub = subscriptions.get(chat_id)
-    if sub is None:
+    if chat_id not in subscriptions:
         await context.bot.send_message(
             chat_id=chat_id, text="you need to be subscribed to ping"
         )
@@ -206,25 +762,47 @@ async def ping_loop(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     async def wait_for_pong():
         try:
-            await asyncio.wait_for(sub.queue.join(), 30)
+            async with cycle_done:
+                await asyncio.wait_for(cycle_done.wait(), 30)
             await context.bot.send_message(chat_id=chat_id, text="pong")
         except Exception as e:
-            print("timed out waiting for queue to join!\n", e)
+            print("timed out waiting for a crawl cycle!\n", e)
 
-    await sub.queue.put("ping")
     asyncio.ensure_future(wait_for_pong())
 
 
-handlers = {
-    "start_handler": CommandHandler("start", start),
-    "subscribe_handler": CommandHandler("subscribe", subscribe),
-    "unsubscribe_handler": CommandHandler("unsubscribe", unsubscribe),
-    "available_handler": CommandHandler("available", available),
-    "hidden_handler": CommandHandler("hidden", hidden),
-    "restricted_handler": CommandHandler("exclusive_access", restricted),
-    "ping_handler": CommandHandler("ping", ping_loop),
-    "view_product_handler": MessageHandler(filters.TEXT, send_product),
-}
+async def profile(update: "Update", context: "ContextTypes.DEFAULT_TYPE"):
+    """/profile [N]: admin only, profile the next N crawl cycles (0 cancels)."""
+    chat_id = get_chat_id(update)
+    if str(chat_id) != str(_admin_chat_id):
+        return
+
+    n = int(context.args[0]) if context.args and context.args[0].isdigit() else 1
+    profiler.request(n)
+    await context.bot.send_message(
+        chat_id=chat_id, text=f"profiling the next {n} cycles, reports go to {profiler.out_dir}"
+    )
+
 
-for handler in handlers.values():
-    application.add_handler(handler)
+def get_handlers() -> dict:
+    """returns: the bot's handlers by name."""
+    from telegram.ext import filters, CommandHandler, MessageHandler
+
+    return {
+        "start_handler": CommandHandler("start", start),
+        "subscribe_handler": CommandHandler("subscribe", subscribe),
+        "unsubscribe_handler": CommandHandler("unsubscribe", unsubscribe),
+        "available_handler": CommandHandler("available", available),
+        "hidden_handler": CommandHandler("hidden", hidden),
+        "restricted_handler": CommandHandler("exclusive_access", restricted),
+        "restocks_handler": CommandHandler("restocks", restocks),
+        "in_stock_handler": CommandHandler("instock", in_stock),
+        "flaps_handler": CommandHandler("flaps", flaps),
+        "ping_handler": CommandHandler("ping", ping_loop),
+        "watch_handler": CommandHandler("watch", watch),
+        "unwatch_handler": CommandHandler("unwatch", unwatch),
+        "watchlist_handler": CommandHandler("watchlist", show_watchlist),
+        "marketplaces_handler": CommandHandler("marketplaces", marketplaces),
+        "profile_handler": CommandHandler("profile", profile),
+        "view_product_handler": MessageHandler(filters.TEXT, send_product),
+    }
@@ -1,92 +1,287 @@
-from typing import Any
-from sqlalchemy.orm import Session
+import json
+import time
+
+from copy import copy
+from typing import Any, NamedTuple, Optional
 from sqlalchemy import func
+from sqlalchemy.orm import Session
+
+from models import Product, Info, Launch, Availability, Subscriber, Watch, ChangeEvent, DISCONTINUED
+from parse import ParsedProduct
+from mirror import StateMirror, ProductState
+from writer import Row
+
+
+# kinds of changes reported by a crawl cycle, see update_product.
+CHANGE_KINDS = ["discontinued", "availability", "launch", "info", "add"]
+
+
+def new_changes() -> dict[str, list[int]]:
+    return {k: [] for k in CHANGE_KINDS}
 
-from models import Product, Info, Launch, Availability
 
-def update_db(session: Session, product_dict: dict[str, Any]) -> dict[str, int]:
+def update_product(product: ParsedProduct, mirror: StateMirror) -> tuple[dict[str, int], list[Row]]:
     """ 
-    update_db compares a product update's pid with existing Product entries in 
-    the database. If there is no existing matching product, a new Product is added 
-    to the database. If any value belonging to "launch", "info", or "availability" has 
-    changed, a new entry will be added/appended to the corresponding table.
+    update_product compares a product update with the product's latest
+    state in mirror. If there is no existing matching product, a new Product
+    is added. If any value belonging to "launch", "info", or "availability"
+    has changed, a new entry will be added/appended to the corresponding table.
+    mirror is updated right away; the database is neither read nor written,
+    the returned rows must be persisted by the caller (see writer.py). A
+    change also appends a ChangeEvent to the rows, with an id assigned by
+    mirror.
 
     returns:
-    a dict that indicates which product_ids (Product.id) have been updated.
-    e.g: {"launch": 123, "availability": 123}
+    a dict that indicates which product_ids (Product.id) have been updated,
+    e.g: {"launch": 123, "availability": 123}, and the rows to insert.
     """
     # changes = {"add": [], "info": [], "launch": [], "availability": []}
     changes = {}
+    ts = int(time.time())
 
-    p_new = Product.from_dict(product_dict)
-    p_old = session.query(Product).filter_by(pid=product_dict["pid"]).first()
+    state = mirror.get(product.marketplace, product.pid)
 
-    if p_old is None:
-        session.add(p_new)
-        session.commit()
-        changes["add"] = p_new.id
-        return changes
-
-    if all(
-        (
-            p_old.info[-1] == p_new.info[-1],
-            p_old.launch[-1] == p_new.launch[-1],
-            p_old.availability[-1] == p_new.availability[-1],
+    if state is None:
+        state = ProductState(
+            product_id=mirror.next_product_id(product.marketplace, product.pid),
+            pid=product.pid,
+            marketplace=product.marketplace,
+            info=product.info,
+            launch=product.launch,
+            availability=product.availability,
+            prev_availability=None,
+            timestamp=ts,
         )
-    ):
-        return changes
+        changes["add"] = state.product_id
 
-    if p_old.info[-1] != p_new.info[-1]:
-        info = Info.from_dict(product_dict)
-        p_old.info.append(info)
-        changes["info"] = p_old.id
+        rows: list[Row] = []
+        # an incomplete product only lacks its state rows.
+        if mirror.incomplete.pop((product.marketplace, product.pid), None) is None:
+            rows.append((Product, {"id": state.product_id, "pid": product.pid, "marketplace": product.marketplace}))
+        mirror.add(state)
+        rows += [
+            (Info, state_row(product.info, state.product_id, ts)),
+            (Launch, state_row(product.launch, state.product_id, ts)),
+            (Availability, state_row(product.availability, state.product_id, ts)),
+            event_row(mirror, state, changes, ts),
+        ]
+        return changes, rows
 
-    if p_old.launch[-1] != p_new.launch[-1]:
-        launch = Launch.from_dict(product_dict)
-        p_old.launch.append(launch)
-        changes["launch"] = p_old.id
+    rows = []
+    if state.info != product.info:
+        rows.append((Info, state_row(product.info, state.product_id, ts)))
+        changes["info"] = state.product_id
+        state.info = product.info
 
-    if p_old.availability[-1] != p_new.availability[-1]:
-        availability = Availability.from_dict(product_dict)
-        p_old.availability.append(availability)
-        changes["availability"] = p_old.id
+    if state.launch != product.launch:
+        rows.append((Launch, state_row(product.launch, state.product_id, ts)))
+        changes["launch"] = state.product_id
+        state.launch = product.launch
 
-    session.commit()
-    return changes
+    if state.availability != product.availability:
+        rows.append((Availability, state_row(product.availability, state.product_id, ts)))
+        changes["availability"] = state.product_id
+        state.prev_availability = state.availability
+        state.availability = product.availability
 
+    if rows:
+        state.timestamp = ts
+        rows.append(event_row(mirror, state, changes, ts))
+    return changes, rows
 
-def handle_discontinued_products(session: Session, pids: list[int]) -> list[int]:
+
+def update_products(
+    products: list[ParsedProduct], mirror: StateMirror, seen: set[int]
+) -> tuple[dict[str, list[int]], list[Row]]:
     """
-    Sometimes products disappear from feed.
-    Find out if and which products Nike took out of their content updates,
-    and update their availability accordingly.
+    update_product for each product, skipping pids in seen (the feed
+    contains duplicates). seen is updated with the products' pids.
+
+    If a product fails, the products before it are rolled back (in mirror
+    and seen) and the exception is raised: the mirror never gets ahead of
+    rows that the caller has not received.
 
     returns:
-    a list of product_ids of discontinued products.
+    the product_ids changed per kind of change, and the rows to insert.
     """
+    all_changes, rows = new_changes(), []
+    # (product, its state before the update, None for new products)
+    undo: list[tuple[ParsedProduct, Optional[ProductState]]] = []
+    max_product_id, max_event_id = mirror.max_product_id, mirror.max_event_id
+    incomplete = dict(mirror.incomplete)
+    try:
+        for product in products:
+            if product.pid in seen:
+                continue
+            seen.add(product.pid)
+
+            state = mirror.get(product.marketplace, product.pid)
+            undo.append((product, copy(state) if state is not None else None))
+            changes, rows_ = update_product(product, mirror)
+            for k, v in changes.items():
+                all_changes[k].append(v)
+            rows += rows_
+    except Exception:
+        for product, old in reversed(undo):
+            seen.discard(product.pid)
+            state = mirror.get(product.marketplace, product.pid)
+            if state is not None:
+                mirror.remove(state)
+            if old is not None:
+                mirror.add(old)
+        mirror.max_product_id, mirror.max_event_id = max_product_id, max_event_id
+        mirror.incomplete = incomplete
+        raise
 
-    # find all products joined with their last available availability status.
-    products = session \
-        .query(Product.pid, Availability.included_in_last_update) \
-        .join(Availability) \
-        .group_by(Availability.product_id) \
-        .having(func.max(Availability.timestamp)) \
-        .all()
+    return all_changes, rows
 
 
+def handle_discontinued_products(
+    pids: list[int], marketplace: str, mirror: StateMirror
+) -> tuple[list[int], list[Row]]:
+    """
+    Sometimes products disappear from feed.
+    Find out if and which products Nike took out of marketplace's content
+    updates, and update their availability accordingly. pids must be the
+    complete set of pids in marketplace's feed.
+
+    returns:
+    a list of product_ids of discontinued products, and the rows to insert.
+    """
+    ts = int(time.time())
+
     # keep only pids where product id was included in the last update.
-    pids_old = set([p[0] for p in products if p[1] == 1])
-    pids_: set[int] = set(pids)
-    insec = pids_.intersection(pids_old)
-    pids_left_over = pids_old - insec
+    pids_left_over = mirror.included_pids(marketplace) - set(pids)
 
-    # update Product/Availability tables for discontinued product_ids.
-    discontinued_product_ids = []
+    discontinued, rows = [], []
     for pid in pids_left_over:
-        p_old = session.query(Product).filter_by(pid=pid).first()
-        assert(p_old is not None) # to make LSP happy
-        p_old.availability.append(Availability.from_scratch())
-        discontinued_product_ids.append(p_old.id)
+        state = mirror.get(marketplace, pid)
+        assert state is not None # to make LSP happy
+        state.prev_availability = state.availability
+        state.availability = DISCONTINUED
+        state.timestamp = ts
+
+        rows.append((Availability, state_row(DISCONTINUED, state.product_id, ts)))
+        rows.append(event_row(mirror, state, {"discontinued": state.product_id}, ts))
+        discontinued.append(state.product_id)
+
+    return discontinued, rows
+
+
+def state_row(state: NamedTuple, product_id: int, ts: int) -> dict[str, Any]:
+    return {**state._asdict(), "product_id": product_id, "timestamp": ts}
+
+
+def event_row(mirror: StateMirror, state: ProductState, changes: dict[str, int], ts: int) -> Row:
+    """returns: the ChangeEvent row of a product's changes (see update_product)."""
+    return (
+        ChangeEvent,
+        {
+            "id": mirror.next_event_id(),
+            "product_id": state.product_id,
+            "kinds": json.dumps(list(changes)),
+            "state": state.to_json(),
+            "timestamp": ts,
+        },
+    )
+
+
+def set_subscribed(
+    session: Session, chat_id: int, active: bool, cursor: Optional[int] = None
+) -> Subscriber:
+    """
+    set_subscribed creates or updates the Subscriber entry for chat_id.
+    Watches are kept when a chat unsubscribes, so that they are still
+    there when it subscribes again.
+
+    A chat that (re)subscribes starts at the end of the change-event log,
+    it is not notified about changes from before. That is cursor, the id of
+    the last event detected so far (see StateMirror.max_event_id), which
+    may not have been written yet. It defaults to the last written event.
+    """
+    sub = session.query(Subscriber).filter_by(chat_id=chat_id).first()
+    if sub is None:
+        sub = Subscriber(chat_id=chat_id, active=False, timestamp=int(time.time()))
+        session.add(sub)
+
+    if active and not sub.active:
+        if cursor is None:
+            cursor = session.query(func.coalesce(func.max(ChangeEvent.id), 0)).scalar()
+        sub.cursor = cursor
+    sub.active = active
+
     session.commit()
+    return sub
+
+
+def set_marketplaces(session: Session, chat_id: int, marketplaces: list[str]) -> Subscriber:
+    """
+    restricts a chat's notifications to products of the given marketplaces.
+    An empty list means all marketplaces.
+    """
+    sub = session.query(Subscriber).filter_by(chat_id=chat_id).first()
+    if sub is None:
+        sub = set_subscribed(session, chat_id, False)
+
+    sub.marketplaces = json.dumps(marketplaces) if marketplaces else None
+    session.commit()
+    return sub
+
+
+def upsert_watch(
+    session: Session, chat_id: int, style_color: str, entry: dict[str, Any]
+) -> Watch:
+    """
+    upsert_watch adds a style_color to a chat's watchlist, or replaces
+    the existing entry for that style_color.
+    entry has the same format as an entry in watchlist.json.
+    """
+    sub = session.query(Subscriber).filter_by(chat_id=chat_id).first()
+    if sub is None:
+        sub = set_subscribed(session, chat_id, False)
+
+    watch = (
+        session.query(Watch)
+        .filter_by(subscriber_id=sub.id, style_color=style_color)
+        .first()
+    )
+    if watch is None:
+        watch = Watch(style_color=style_color, subscriber=sub)
+        session.add(watch)
 
-    return discontinued_product_ids
+    watch.sizes = json.dumps(entry.get("sizes", []))
+    watch.include_restricted = entry.get("include_restricted", True)
+    watch.comment = entry.get("comment", "")
+    watch.excluded = entry.get("excluded", False)
+    watch.timestamp = int(time.time())
+
+    session.commit()
+    return watch
+
+
+def remove_watch(session: Session, chat_id: int, style_color: str) -> Optional[Watch]:
+    """
+    returns:
+    the removed Watch, or None if chat_id was not watching style_color.
+    """
+    watch = (
+        session.query(Watch)
+        .join(Subscriber)
+        .filter(Subscriber.chat_id == chat_id, Watch.style_color == style_color)
+        .first()
+    )
+    if watch is None:
+        return None
+
+    session.delete(watch)
+    session.commit()
+    return watch
+
+
+def cursor_rows(cursors: dict[int, int]) -> list[Row]:
+    """
+    returns:
+    the rows that advance the change-event cursor of each chat_id in
+    cursors, see writer.write_rows.
+    """
+    return [(Subscriber, {"chat_id": chat_id, "cursor": cursor}) for chat_id, cursor in cursors.items()]
@@ -1,42 +1,185 @@
-import queries
+import os
+import sys
+import json
+import asyncio
 
-from typing import Any
-from sqlalchemy.orm import Session
-from models import Product
+from typing import TYPE_CHECKING, Any, Iterable, Iterator
 
+if TYPE_CHECKING:
+    from sqlalchemy.orm import Session
+    from mirror import ProductState
 
-def has_become_available(p: Product, sizes: list[str], restricted: bool) -> bool:
-    prev_available = queries.is_available(p, -2, sizes=sizes, restricted=restricted)
-    curr_available = queries.is_available(p, -1, sizes=sizes, restricted=restricted)
+# watches loaded from watchlist.json are shared by all subscribed chats.
+SHARED = 0
+
+
+class WatchlistIndex:
+    """
+    WatchlistIndex maps style_colors to the chats that watch them, so that
+    a changed product can be matched against all watchlists with a single
+    dict lookup. Entries are added and removed in place; the index is
+    never rebuilt as a whole.
+
+    entries: {style_color: {chat_id: entry}}, where entry has the same
+    format as an entry in watchlist.json. chat_id SHARED holds the entries
+    of watchlist.json, which apply to every chat that has no entry of its
+    own for that style_color. A chat opts out of a shared entry with an
+    entry of its own that is "excluded".
+    """
+
+    def __init__(self):
+        self.entries: dict[str, dict[int, dict[str, Any]]] = {}
+
+    def add(self, chat_id: int, style_color: str, entry: dict[str, Any]):
+        self.entries.setdefault(style_color, {})[chat_id] = entry
+
+    def remove(self, chat_id: int, style_color: str):
+        chats = self.entries.get(style_color)
+        if chats is None:
+            return
+
+        chats.pop(chat_id, None)
+        if not chats:
+            self.entries.pop(style_color)
+
+    def style_colors(self) -> list[str]:
+        return list(self.entries.keys())
+
+    def watchlist(self, chat_id: int) -> dict[str, dict[str, Any]]:
+        """
+        returns:
+        the effective watchlist of chat_id in watchlist.json format.
+        """
+        watchlist = {}
+        for style_color, chats in self.entries.items():
+            entry = chats.get(chat_id, chats.get(SHARED))
+            if entry is not None and not entry.get("excluded"):
+                watchlist[style_color] = entry
+        return watchlist
+
+    def match(
+        self, style_color: str, chat_ids: Iterable[int]
+    ) -> Iterator[tuple[int, dict[str, Any]]]:
+        """
+        returns:
+        (chat_id, entry) for each chat in chat_ids that watches style_color.
+        """
+        chats = self.entries.get(style_color)
+        if chats is None:
+            return
+
+        shared = chats.get(SHARED)
+        for chat_id in chat_ids:
+            entry = chats.get(chat_id, shared)
+            if entry is not None and not entry.get("excluded"):
+                yield chat_id, entry
+
+    def load_shared(self, watchlist: dict[str, dict[str, Any]]) -> dict[str, int]:
+        """
+        load_shared applies a (re)loaded watchlist.json to the index,
+        touching only the entries that were added, changed or removed.
+
+        returns:
+        the number of added, changed and removed entries.
+        """
+        counts = {"added": 0, "changed": 0, "removed": 0}
+
+        old = {
+            style_color: chats[SHARED]
+            for style_color, chats in self.entries.items()
+            if SHARED in chats
+        }
+
+        for style_color in old.keys() - watchlist.keys():
+            self.remove(SHARED, style_color)
+            counts["removed"] += 1
+
+        for style_color, entry in watchlist.items():
+            if style_color not in old:
+                counts["added"] += 1
+            elif old[style_color] != entry:
+                counts["changed"] += 1
+            else:
+                continue
+            self.add(SHARED, style_color, entry)
+
+        return counts
+
+    def load_watches(self, session: "Session"):
+        """load the watches of all chats from the database."""
+        import queries
+
+        for chat_id, watch in queries.query_watches(session):
+            self.add(chat_id, watch.style_color, watch.to_dict())
+
+
+async def watch_file(index: WatchlistIndex, path: str, interval_sec: float = 5):
+    """
+    watch_file polls path for modifications, and incrementally reloads
+    the shared watchlist into index whenever the file has changed.
+    Files that cannot be parsed (e.g. while they are being edited) are
+    ignored until the next modification.
+    """
+    mtime = None
+
+    while True:
+        try:
+            mtime_ = os.stat(path).st_mtime
+            if mtime_ != mtime:
+                with open(path, "r") as f:
+                    watchlist = json.load(f)
+                mtime = mtime_
+
+                counts = index.load_shared(watchlist)
+                if any(counts.values()):
+                    sys.stdout.write(f"\nreloaded {path}: {counts}\n")
+        except (OSError, ValueError) as e:
+            sys.stdout.write(f"\nfailed to reload {path}:\n{e}\n")
+
+        await asyncio.sleep(interval_sec)
+
+
+def has_become_available(state: "ProductState", sizes: list[str], restricted: bool) -> bool:
+    import queries
+
+    prev_available = queries.is_state_available(
+        state.prev_availability, state.launch, sizes=sizes, restricted=restricted
+    )
+    curr_available = queries.is_state_available(
+        state.availability, state.launch, sizes=sizes, restricted=restricted
+    )
     return not prev_available and curr_available
 
 
 def should_notify(
-    session: Session,
-    watchlist: dict[str, dict[str, Any]],
-    all_changes: dict[str, list[int]],
-) -> list[Product]:
+    states: list["ProductState"],
+    index: WatchlistIndex,
+    chat_marketplaces: dict[int, list[str]],
+) -> dict[int, list["ProductState"]]:
     """
+    states are the states of products right after their availability
+    changed (or they were added), e.g. from ChangeEvent.state.
+    chat_marketplaces maps each chat_id to the marketplaces it wants to be
+    notified about, an empty list meaning all marketplaces.
+
     returns:
-    a list of products that have become available in the most recent step.
+    a mapping of chat_id to the watched products that have become
+    available, in the order of states.
     """
-    skus = list(watchlist.keys())
-    watched_products = queries.query_products_by_style_color(session, style_colors=skus)
-
-    notify = []
-    for p in watched_products:
-        info = watchlist[p.info[-1].style_color]
-
-        if p is None:
+    notify: dict[int, list["ProductState"]] = {}
+    for state in states:
+        if state.info.style_color not in index.entries:
             continue
 
-        if p.id in all_changes["availability"] or all_changes["add"]:
-            is_notify_restricted = has_become_available(p, info.get("sizes", []), True)
-            is_notify = has_become_available(p, info.get("sizes", []), False)
+        chat_ids = [
+            chat_id
+            for chat_id, marketplaces in chat_marketplaces.items()
+            if not marketplaces or state.marketplace in marketplaces
+        ]
+        for chat_id, info in index.match(state.info.style_color, chat_ids):
+            is_notify_restricted = has_become_available(state, info.get("sizes", []), True)
+            is_notify = has_become_available(state, info.get("sizes", []), False)
             if is_notify or (is_notify_restricted and info.get("include_restricted")):
-                notify.append(p)
-
-        if p.id in all_changes["launch"]:
-            pass
+                notify.setdefault(chat_id, []).append(state)
 
     return notify
@@ -0,0 +1,208 @@
+import os
+import sys
+import json
+import time
+import asyncio
+
+from typing import Any, Callable, Optional
+from sqlalchemy import insert, update, func, bindparam
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import Session
+
+from database import Base, get_session
+from models import Product, Info, Launch, Availability, ChangeEvent, Subscriber
+
+# a row to insert: (model, column values). Subscriber rows advance a
+# chat's cursor instead, see write_rows.
+Row = tuple[type[Base], dict[str, Any]]
+
+# parents are inserted before their children.
+INSERT_ORDER = [Product, Info, Launch, Availability, ChangeEvent]
+
+# batches that could not be written, one json line per batch.
+DEAD_LETTER_PATH = os.path.join(os.path.dirname(__file__), "failed_rows.jsonl")
+
+
+def write_rows(rows: list[Row], fence: Optional[Callable[[Session], None]] = None):
+    """
+    inserts rows with one executemany per table, in a single transaction.
+    fence(session) runs first in that transaction, and raises to prevent
+    the write (see shard.lease_fence).
+
+    Subscriber rows ({"chat_id", "cursor"}) are not inserted but raise the
+    chat's cursor to cursor, after the events it points past have been
+    inserted. A cursor is never lowered, e.g. by an advance that was
+    queued before the chat subscribed again.
+    """
+    by_model: dict[type[Base], list[dict[str, Any]]] = {model: [] for model in [*INSERT_ORDER, Subscriber]}
+    for model, values in rows:
+        by_model[model].append(values)
+    cursors = [{"chat": v["chat_id"], "new_cursor": v["cursor"]} for v in by_model.pop(Subscriber)]
+
+    with get_session() as session:
+        if fence is not None:
+            fence(session)
+        for model, values in by_model.items():
+            if values:
+                session.execute(insert(model.__table__), values)
+        if cursors:
+            session.execute(
+                update(Subscriber.__table__)
+                .where(Subscriber.chat_id == bindparam("chat"))
+                .values(cursor=func.max(Subscriber.cursor, bindparam("new_cursor"))),
+                cursors,
+            )
+        session.commit()
+
+
+def product_id(row: Row) -> Optional[int]:
+    """returns: the product_id of row, None for a Subscriber row."""
+    model, values = row
+    if model is Subscriber:
+        return None
+    return values["id"] if model is Product else values["product_id"]
+
+
+def product_groups(rows: list[Row]) -> list[list[Row]]:
+    """
+    returns:
+    rows grouped by product, in the order in which the products first
+    appear in rows. Subscriber rows form a group of their own.
+    """
+    groups: dict[Optional[int], list[Row]] = {}
+    for row in rows:
+        groups.setdefault(product_id(row), []).append(row)
+    return list(groups.values())
+
+
+class WriteBehindQueue:
+    """
+    WriteBehindQueue persists rows in the background, so that a crawl cycle
+    does not wait for the database. The rows of a product are queued as one
+    unit (see put), in a bounded queue: put blocks while max_pending
+    products are waiting, which slows the producer down to the speed of the
+    disk instead of buffering without limit.
+
+    The writer task (run) collects rows for up to max_delay_sec, possibly
+    across several cycles, and writes them in batches of about batch_size
+    rows. A product's rows are never split across batches, so that a
+    failed batch can't leave a Product without its Info, Launch and
+    Availability rows, or those without their Product. A batch that fails with an OperationalError (e.g. the database is
+    locked) is retried up to max_retries times, because the state mirror
+    already reflects it. A batch that still fails, or fails with any other
+    error (e.g. an IntegrityError), is appended to dead_letter_path and
+    dropped, so that it does not hold up all later writes. dropped counts
+    those batches; the mirror has to be reloaded after one (see
+    pipeline.check_mirror).
+
+    on_commit is called with the product_ids of each written batch.
+
+    fence, if set, is passed on to write_rows, e.g. so that only the
+    current leader of the crawler workers writes.
+    """
+
+    def __init__(
+        self,
+        max_pending: int = 20_000,
+        batch_size: int = 5_000,
+        max_delay_sec: float = 1,
+        retry_sec: float = 5,
+        max_retries: int = 12,
+        dead_letter_path: str = DEAD_LETTER_PATH,
+        on_commit: Optional[Callable[[set[int]], Any]] = None,
+    ):
+        self.queue: asyncio.Queue = asyncio.Queue(max_pending)
+        self.batch_size = batch_size
+        self.max_delay_sec = max_delay_sec
+        self.retry_sec = retry_sec
+        self.max_retries = max_retries
+        self.dead_letter_path = dead_letter_path
+        self.on_commit = on_commit
+        self.fence: Optional[Callable[[Session], None]] = None
+        self.task: Optional[asyncio.Task] = None
+        self.dropped = 0
+
+    async def put(self, rows: list[Row]):
+        """queues rows, the rows of each product as one unit (see product_groups)."""
+        for group in product_groups(rows):
+            await self.queue.put(group)
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.ensure_future(self.run())
+
+    async def run(self):
+        while True:
+            groups = [await self.queue.get()]
+            n = len(groups[0])
+
+            # wait a little for more rows, to write them in one transaction.
+            deadline = time.monotonic() + self.max_delay_sec
+            while n < self.batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    groups.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+                n += len(groups[-1])
+
+            await self.write(groups)
+
+    async def write(self, groups: list[list[Row]]):
+        batch = [row for group in groups for row in group]
+        try:
+            await self.write_with_retries(batch)
+        except Exception as e:
+            sys.stdout.write(f"\nfailed to write {len(batch)} rows, dropping them:\n{e}\n")
+            self.dead_letter(batch, e)
+            self.dropped += 1
+        else:
+            self.committed(batch)
+
+        for _ in groups:
+            self.queue.task_done()
+
+    async def write_with_retries(self, batch: list[Row]):
+        for retry in range(self.max_retries + 1):
+            try:
+                await asyncio.to_thread(write_rows, batch, self.fence)
+                return
+            except OperationalError as e:
+                if retry == self.max_retries:
+                    raise
+                sys.stdout.write(f"\nfailed to write {len(batch)} rows, retrying:\n{e}\n")
+                await asyncio.sleep(self.retry_sec)
+
+    def dead_letter(self, batch: list[Row], e: Exception):
+        """appends batch to dead_letter_path, so that it can be inspected later."""
+        try:
+            with open(self.dead_letter_path, "a") as f:
+                rows = [[model.__tablename__, values] for model, values in batch]
+                f.write(json.dumps({"timestamp": int(time.time()), "error": repr(e), "rows": rows}, default=str) + "\n")
+        except OSError as e:
+            sys.stdout.write(f"\nfailed to write to {self.dead_letter_path}:\n{e}\n")
+
+    def committed(self, batch: list[Row]):
+        if self.on_commit is not None:
+            product_ids = set(id for id in map(product_id, batch) if id is not None)
+            if product_ids:
+                self.on_commit(product_ids)
+
+    async def flush(self):
+        """blocks until all rows that have been put are committed (or dropped)."""
+        self.start()
+        await self.queue.join()
+
+    async def close(self):
+        """flush, then stop the writer task."""
+        if self.task is None:
+            return
+
+        await self.flush()
+        self.task.cancel()
+        self.task = None
+
+
+write_queue = WriteBehindQueue()